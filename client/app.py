@@ -1,4 +1,6 @@
+import json
 import threading
+import time
 
 import requests
 import streamlit as st
@@ -9,17 +11,37 @@ def upload_files(files):
     url = "http://localhost:8000/upload-file/"
     success_count = 0
     error_messages = []
+    jobs = {}
 
     for file in files:
         filename = file.name
         mime_type = file.type
         file_data = {"file": (filename, file.getvalue(), mime_type)}
         response = requests.post(url, files=file_data)
-        if response.status_code == 200:
-            success_count += 1
+        if response.status_code in (200, 202):
+            result = response.json()
+            # 200 is a duplicate, either already ingested or waiting for ingestion
+            if result.get("document_id"):
+                st.info(f"'{filename}' is already stored as document '{result['document_id']}'")
+                success_count += 1
+            else:
+                jobs[filename] = result["job_id"]
         else:
             error_messages.append(f"Failed to upload '{filename}': {response.text}")
 
+    # Wait for the server to finish ingesting the uploaded files
+    while jobs:
+        time.sleep(1)
+        for filename, job_id in list(jobs.items()):
+            job = requests.get(url + job_id).json()
+            if job["status"] == "done":
+                success_count += 1
+            elif job["status"] == "failed":
+                error_messages.append(f"Failed to process '{filename}': {job['error']}")
+            else:
+                continue
+            del jobs[filename]
+
     if success_count == len(files):
         st.success("All files uploaded successfully")
     elif success_count == 0:
@@ -32,13 +54,47 @@ def upload_files(files):
 
 def chat_with_server(question):
     url = "http://localhost:8000/chat/"
-    response = requests.get(url, params={"query": question})
+    params = {"query": question}
+    if st.session_state.get("session_id"):
+        params["session_id"] = st.session_state.session_id
+    response = requests.get(url, params=params)
     if response.status_code == 200:
+        st.session_state.session_id = response.headers.get("X-Session-Id")
         return response.text
     else:
         return f"Failed to get response: {response.status_code}"
 
 
+def stream_chat_with_server(question, metrics):
+    # Yields answer tokens from the server-sent event stream of /chat/
+    url = "http://localhost:8000/chat/"
+    params = {"query": question, "stream": True}
+    if st.session_state.get("session_id"):
+        params["session_id"] = st.session_state.session_id
+
+    with requests.get(url, params=params, stream=True) as response:
+        if response.status_code != 200:
+            yield f"Failed to get response: {response.status_code}"
+            return
+        # Follow-up questions continue the same server-side conversation
+        st.session_state.session_id = response.headers.get("X-Session-Id")
+
+        event = None
+        for line in response.iter_lines(decode_unicode=True):
+            if line.startswith("event: "):
+                event = line[len("event: "):]
+            elif line.startswith("data: "):
+                data = json.loads(line[len("data: "):])
+                if event == "token":
+                    yield data
+                elif event == "sources":
+                    metrics["sources"] = data
+                elif event == "done":
+                    metrics.update(data)
+                elif event == "error":
+                    yield f"Failed to get response: {data['error']}"
+
+
 def update_chat():
     for i, msg in enumerate(st.session_state.conversation_chain):
         if i % 2 == 0:
@@ -50,9 +106,15 @@ def update_chat():
 
 
 def run_chat(question):
-    response = chat_with_server(question)
+    metrics = {}
+    with st.chat_message("ai"):
+        response = st.write_stream(stream_chat_with_server(question, metrics))
+        if metrics.get("time_to_first_token") is not None:
+            st.caption(
+                f"Erstes Token nach {metrics['time_to_first_token']:.2f} s, "
+                f"{metrics['tokens_per_second'] or 0:.1f} Tokens/s"
+            )
     st.session_state.conversation_chain.append({"role": "ai", "content": response})
-    update_chat()
 
 
 def main():
@@ -0,0 +1,82 @@
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+ANSWER_CACHE_SIZE = int(os.environ.get("ANSWER_CACHE_SIZE", "512"))
+ANSWER_CACHE_THRESHOLD = float(os.environ.get("ANSWER_CACHE_THRESHOLD", "0.95"))
+
+
+class SemanticAnswerCache():
+    """LRU cache of chat answers, looked up by cosine similarity of the
+    question embedding. `generation` returns a stamp of the ingested document
+    set; the cache is cleared whenever that stamp changes."""
+
+    def __init__(
+        self,
+        embedding_model,
+        generation,
+        max_entries=ANSWER_CACHE_SIZE,
+        threshold=ANSWER_CACHE_THRESHOLD,
+    ):
+        self.embedding_model = embedding_model
+        self.generation = generation
+        self.max_entries = max_entries
+        self.threshold = threshold
+        self._entries = OrderedDict()
+        self._generation = None
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def _embed(self, question):
+        vector = np.asarray(self.embedding_model.embed_query(question), dtype=np.float32)
+        return vector / max(np.linalg.norm(vector), 1e-12)
+
+    def _check_generation(self):
+        generation = self.generation()
+        if generation != self._generation:
+            if self._entries:
+                self.invalidations += 1
+            self._entries.clear()
+            self._generation = generation
+
+    def lookup(self, question):
+        vector = self._embed(question)
+        with self._lock:
+            self._check_generation()
+            best, best_similarity = None, self.threshold
+            for key, (cached_vector, _) in self._entries.items():
+                similarity = float(cached_vector @ vector)
+                if similarity >= best_similarity:
+                    best, best_similarity = key, similarity
+
+            if best is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._entries.move_to_end(best)
+            return self._entries[best][1]
+
+    def store(self, question, answer, sources):
+        vector = self._embed(question)
+        with self._lock:
+            self._check_generation()
+            self._entries[question] = (vector, {"answer": answer, "sources": sources})
+            self._entries.move_to_end(question)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "threshold": self.threshold,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else None,
+            "invalidations": self.invalidations,
+        }
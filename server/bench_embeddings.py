@@ -0,0 +1,56 @@
+import argparse
+import time
+
+import numpy as np
+from server.chunking import PageChunker
+from server.embeddings import EMBEDDING_BATCH_SIZE, EMBEDDING_THREADS, make_embeddings
+from server.pdftext import iter_pdf_pages
+from server.vectordb import VectorStore
+
+
+def get_chunks(files):
+    # Same chunks as ingestion
+    return [chunk.text for chunk in PageChunker().split(iter_pdf_pages(files))]
+
+
+def top_k(vectors, k):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    similarities = vectors @ vectors.T
+    np.fill_diagonal(similarities, -np.inf)
+    return np.argsort(-similarities, axis=1)[:, :k]
+
+
+def bench(backend, chunks, batch_size, threads):
+    model = make_embeddings(VectorStore.model_name, backend=backend, batch_size=batch_size, threads=threads)
+    model.embed_documents(chunks[:batch_size])  # warm up
+
+    start = time.perf_counter()
+    vectors = model.embed_documents(chunks)
+    seconds = time.perf_counter() - start
+    return vectors, len(chunks) / seconds
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare the embedding backends")
+    parser.add_argument("files", nargs="+", help="PDF files to take the chunks from")
+    parser.add_argument("--backends", nargs="+", default=["torch", "onnx"])
+    parser.add_argument("--batch-size", type=int, default=EMBEDDING_BATCH_SIZE)
+    parser.add_argument("--threads", type=int, default=EMBEDDING_THREADS)
+    parser.add_argument("-k", type=int, default=5, help="Neighbours compared for recall@k")
+    args = parser.parse_args()
+
+    chunks = get_chunks(args.files)
+    print(f"{len(chunks)} chunks, batch size {args.batch_size}, threads {args.threads or 'default'}")
+
+    # Recall@k: overlap of each chunk's nearest neighbours with those of the first backend
+    reference = None
+    for backend in args.backends:
+        vectors, chunks_per_second = bench(backend, chunks, args.batch_size, args.threads)
+        neighbours = top_k(vectors, args.k)
+        if reference is None:
+            reference = neighbours
+        recall = np.mean(
+            [len(set(a) & set(b)) / args.k for a, b in zip(reference, neighbours)]
+        )
+        print(f"{backend:>8}: {chunks_per_second:8.1f} chunks/s, recall@{args.k} {recall:.3f}")
@@ -0,0 +1,69 @@
+import argparse
+import os
+import tempfile
+import time
+
+from sqlalchemy import create_engine, event, select
+from sqlalchemy.orm import sessionmaker
+
+from server.process_document import record_form
+from server.schlagwortdb import models
+from server.schlagwortdb.migrations import migrate
+
+
+def record_form_per_field(filename, file_id, fields, session):
+    # The previous implementation: two SELECTs and up to two flushes per field
+    doc = models.DokumentLookup(docName=file_id, docOrigName=filename)
+    session.add(doc)
+    session.flush()
+    for name, field_type in fields.items():
+        schlagwort = session.execute(
+            select(models.Schlagwort).where(models.Schlagwort.schlagwort == name)
+        ).scalar()
+        if not schlagwort:
+            schlagwort = models.Schlagwort(schlagwort=name)
+            session.add(schlagwort)
+            session.flush()
+        feld = session.execute(select(models.Feld).where(models.Feld.feldname == name)).scalar()
+        if not feld:
+            session.add(models.Feld(schlagwort=schlagwort.pkey, feldname=name, feldtyp=field_type))
+            session.flush()
+        session.add(models.SchlagwortDokument(schlagwort=schlagwort.pkey, dokument=doc.pkey))
+    return True
+
+
+def bench(record, n_fields, runs):
+    with tempfile.TemporaryDirectory() as tmp:
+        engine = create_engine(f"sqlite:///{os.path.join(tmp, 'bench.sqlite')}")
+        migrate(engine)
+        statements = [0]
+        event.listen(engine, "before_cursor_execute", lambda *args: statements.__setitem__(0, statements[0] + 1))
+
+        fields = {f"Feld_{i}": "/Tx" for i in range(n_fields)}
+        results = []
+        with sessionmaker(bind=engine)() as session:
+            # The first run creates every Schlagwort and Feld, the others find them
+            for run in range(runs):
+                statements[0] = 0
+                start = time.perf_counter()
+                record(f"form_{run}.pdf", f"form_{run}", fields, session)
+                session.commit()
+                results.append((time.perf_counter() - start, statements[0]))
+        engine.dispose()
+        return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark recording a synthetic form in the database")
+    parser.add_argument("--fields", type=int, default=500)
+    parser.add_argument("--runs", type=int, default=5)
+    args = parser.parse_args()
+
+    for name, record in [("per-field", record_form_per_field), ("bulk", record_form)]:
+        results = bench(record, args.fields, args.runs)
+        cold, warm = results[0], results[1:]
+        print(f"{name}: new form {cold[0] * 1000:.1f} ms / {cold[1]} statements", end="")
+        if warm:
+            seconds = sum(result[0] for result in warm) / len(warm)
+            print(f", known form {seconds * 1000:.1f} ms / {warm[0][1]} statements", end="")
+        print()
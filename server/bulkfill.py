@@ -0,0 +1,168 @@
+import argparse
+import io
+import multiprocessing
+import os
+import time
+import zipfile
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+from pypdf import PdfReader
+from sqlalchemy import select
+from sqlalchemy.orm import joinedload
+
+from server.formfill import build_stammdaten, field_values, fill_form
+from server.schlagwortdb import models
+
+BULK_FILL_WORKERS = int(os.environ.get("BULK_FILL_WORKERS", str(os.cpu_count() or 1)))
+# Customers loaded per query
+BULK_FILL_BATCH = int(os.environ.get("BULK_FILL_BATCH", "500"))
+
+
+def iter_stammdaten(session, kunde_ids=None, batch_size=BULK_FILL_BATCH):
+    """Yield (pkey, Stammdaten) for the given customers, or all of them, in
+    pkey order. Customers and their addresses are loaded with one joined query
+    per batch, and the session is emptied after every batch so memory stays
+    flat."""
+    query = select(models.Kunde).options(joinedload(models.Kunde.adresse_obj)).order_by(models.Kunde.pkey)
+    if kunde_ids is not None:
+        kunde_ids = sorted(set(kunde_ids))
+        batches = (
+            query.where(models.Kunde.pkey.in_(kunde_ids[i : i + batch_size]))
+            for i in range(0, len(kunde_ids), batch_size)
+        )
+        for batch in batches:
+            for kunde in session.execute(batch).scalars():
+                yield kunde.pkey, build_stammdaten(kunde)
+            session.expunge_all()
+        return
+
+    # Keyset pagination, OFFSET would rescan all previous rows
+    last = 0
+    while True:
+        kunden = session.execute(query.where(models.Kunde.pkey > last).limit(batch_size)).scalars().all()
+        if not kunden:
+            return
+        for kunde in kunden:
+            yield kunde.pkey, build_stammdaten(kunde)
+        last = kunden[-1].pkey
+        session.expunge_all()
+
+
+# Set in every worker process by _init_worker, so the template is parsed once per worker
+_template = None
+_mapping = None
+
+
+def _init_worker(template, mapping):
+    global _template, _mapping
+    _template = PdfReader(io.BytesIO(template))
+    _mapping = mapping
+
+
+def _fill(pkey, stammdaten):
+    return pkey, fill_form(_template, field_values(_mapping, stammdaten))
+
+
+def fill_many(template, mapping, stammdaten, workers=BULK_FILL_WORKERS, window=None):
+    """Yield (pkey, filled PDF) for every (pkey, Stammdaten) in `stammdaten`,
+    in order. `template` is the PDF's bytes, `mapping` maps its fields to
+    tuples of Stammdaten keys. At most `window` forms are in flight."""
+    if workers <= 1:
+        _init_worker(template, mapping)
+        for pkey, values in stammdaten:
+            yield _fill(pkey, values)
+        return
+
+    window = window or 2 * workers
+    pending = deque()
+    # spawn, because forking a process that holds torch and CUDA state is unsafe
+    with ProcessPoolExecutor(
+        max_workers=workers,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=_init_worker,
+        initargs=(template, mapping),
+    ) as executor:
+        try:
+            for pkey, values in stammdaten:
+                pending.append(executor.submit(_fill, pkey, values))
+                if len(pending) >= window:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+        finally:
+            for future in pending:
+                future.cancel()
+
+
+class _ZipSink():
+    # Write-only stream, zipfile then writes data descriptors instead of seeking back
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def take(self):
+        data = b"".join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def stream_zip(files):
+    """Yield the bytes of a ZIP archive of the (name, content) pairs in
+    `files`, one file at a time."""
+    sink = _ZipSink()
+    with zipfile.ZipFile(sink, "w", compression=zipfile.ZIP_DEFLATED) as archive:
+        for name, content in files:
+            archive.writestr(name, content)
+            yield sink.take()
+    yield sink.take()
+
+
+def bulk_fill(template_path, mapping, session, kunde_ids=None, workers=BULK_FILL_WORKERS):
+    """Yield the chunks of a ZIP with the template filled for every customer."""
+    with open(template_path, "rb") as f:
+        template = f.read()
+    stem = os.path.splitext(os.path.basename(template_path))[0]
+
+    filled = fill_many(template, mapping, iter_stammdaten(session, kunde_ids), workers)
+    yield from stream_zip((f"{stem}_{pkey}.pdf", pdf) for pkey, pdf in filled)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fill one form for many customers into a ZIP")
+    parser.add_argument("template", help="The form to fill")
+    parser.add_argument("output", help="The ZIP file to write")
+    parser.add_argument("--kunden", type=int, nargs="+", help="Customer IDs, all customers by default")
+    parser.add_argument("--workers", type=int, default=BULK_FILL_WORKERS)
+    args = parser.parse_args()
+
+    from server.embeddings import CachedEmbeddings, cache_namespace, make_embeddings
+    from server.field_matcher import FieldMatcher
+    from server.schlagwortdb.database import SessionLocal
+    from server.vectordb import VectorStore
+
+    start = time.time()
+    embeddings = CachedEmbeddings(
+        make_embeddings(VectorStore.model_name), namespace=cache_namespace(VectorStore.model_name)
+    )
+    matcher = FieldMatcher(embeddings, SessionLocal)
+    fields = list(PdfReader(args.template).get_fields() or {})
+    mapping = {
+        field: match.keys
+        for field, match in matcher.match(fields).items()
+        if matcher.accepted(match)
+    }
+    print(f"Mapped {len(mapping)} of {len(fields)} fields")
+
+    n_bytes = 0
+    with SessionLocal() as session, open(args.output, "wb") as out:
+        for chunk in bulk_fill(args.template, mapping, session, args.kunden, args.workers):
+            n_bytes += out.write(chunk)
+    elapsed = time.time() - start
+    print(f"Wrote {n_bytes / 1024 / 1024:.1f} MB to {args.output} in {elapsed:.1f}s")
@@ -0,0 +1,28 @@
+import os
+from collections import namedtuple
+
+from langchain_text_splitters import RecursiveCharacterTextSplitter
+
+CHUNK_SIZE = int(os.environ.get("CHUNK_SIZE", "400"))
+CHUNK_OVERLAP = int(os.environ.get("CHUNK_OVERLAP", "50"))
+
+# `offset` is the position of the chunk's first character in the page's text
+Chunk = namedtuple("Chunk", ["text", "page", "offset"])
+
+
+class PageChunker():
+    """Splits the pages of one document into chunks that never cross a page,
+    so every chunk can be traced back to its page and position on it."""
+
+    def __init__(self, chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP):
+        self.splitter = RecursiveCharacterTextSplitter(
+            chunk_size=chunk_size, chunk_overlap=chunk_overlap, add_start_index=True
+        )
+
+    def split(self, pages):
+        """Yields a Chunk for every chunk of `pages`, PdfPages of one file."""
+        for page in pages:
+            if not page.text.strip():
+                continue
+            for doc in self.splitter.create_documents([page.text]):
+                yield Chunk(doc.page_content, page.page, doc.metadata["start_index"])
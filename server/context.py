@@ -0,0 +1,101 @@
+import os
+from typing import Any
+
+import numpy as np
+from langchain_community.vectorstores.utils import maximal_marginal_relevance
+from langchain_core.callbacks import CallbackManagerForRetrieverRun
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+
+# Tokens of retrieved text in a /chat/ prompt. About what the former four
+# chunks of up to 400 characters took, the rest of n_ctx is left for the
+# prompt template, the chat history and the answer
+CONTEXT_MAX_TOKENS = int(os.environ.get("CONTEXT_MAX_TOKENS", "500"))
+# Chunks retrieved before merging, MMR and packing pick from them
+CONTEXT_CANDIDATES = int(os.environ.get("CONTEXT_CANDIDATES", "8"))
+# 1.0 ranks by relevance only, lower values prefer diverse chunks
+CONTEXT_MMR_LAMBDA = float(os.environ.get("CONTEXT_MMR_LAMBDA", "0.7"))
+# The splitter drops the whitespace it splits at, so chunks that follow each
+# other directly can be this many characters apart
+MERGE_GAP = 2
+
+
+def merge_chunks(docs):
+    """Merges chunks of the same page that overlap or follow each other.
+    Returns (Document, indices of its chunks in `docs`) pairs ordered by the
+    best rank of their chunks. Chunks without an offset are kept as they are."""
+    merged = []
+    pages = {}
+    for i, doc in enumerate(docs):
+        if doc.metadata.get("offset") is None:
+            merged.append((doc, [i]))
+        else:
+            pages.setdefault((doc.metadata.get("document_id"), doc.metadata.get("page")), []).append(i)
+
+    for indices in pages.values():
+        indices.sort(key=lambda i: docs[i].metadata["offset"])
+        parts, text, start = [], "", None
+        for i in indices:
+            offset, content = docs[i].metadata["offset"], docs[i].page_content
+            end = start + len(text) if parts else None
+            if parts and offset <= end + MERGE_GAP:
+                text += content[end - offset:] if offset <= end else "\n" + content
+                parts.append(i)
+                continue
+            if parts:
+                merged.append((Document(text, metadata={**docs[parts[0]].metadata, "offset": start}), parts))
+            parts, text, start = [i], content, offset
+        merged.append((Document(text, metadata={**docs[parts[0]].metadata, "offset": start}), parts))
+
+    return sorted(merged, key=lambda pair: min(pair[1]))
+
+
+def pack(docs, count_tokens, max_tokens, separator="\n\n"):
+    """The longest prefix of `docs`, skipping documents that don't fit, whose
+    texts joined by `separator` are at most `max_tokens` tokens."""
+    separator_tokens = count_tokens(separator)
+    packed, used = [], 0
+    for doc in docs:
+        tokens = count_tokens(doc.page_content) + (separator_tokens if packed else 0)
+        if used + tokens <= max_tokens:
+            packed.append(doc)
+            used += tokens
+    # Tokens can merge across the seams, so check the text as the prompt sees it
+    while packed and count_tokens(separator.join(doc.page_content for doc in packed)) > max_tokens:
+        packed.pop()
+    return packed
+
+
+class ContextAssembler(BaseRetriever):
+    """Turns the chunks of another retriever into the context of a prompt:
+    chunks of the same page that overlap or touch are merged, the results are
+    ordered by maximal marginal relevance, so near-duplicates don't crowd out
+    other sources, and packed into `max_tokens` tokens of the chat model.
+    `count_tokens` must count without a BOS token, so that the counts of the
+    pieces add up to the count of the packed text.
+
+    `embeddings` should be the CachedEmbeddings the chunks were indexed with,
+    then no chunk is embedded again. A merged chunk is represented by the mean
+    of its chunks' vectors."""
+
+    retriever: BaseRetriever
+    embeddings: Any
+    count_tokens: Any
+    max_tokens: int = CONTEXT_MAX_TOKENS
+    mmr_lambda: float = CONTEXT_MMR_LAMBDA
+    separator: str = "\n\n"
+
+    def _get_relevant_documents(self, query: str, *, run_manager: CallbackManagerForRetrieverRun):
+        docs = self.retriever.invoke(query, config={"callbacks": run_manager.get_child()})
+        if not docs:
+            return []
+
+        merged = merge_chunks(docs)
+        vectors = np.asarray(self.embeddings.embed_documents([doc.page_content for doc in docs]))
+        order = maximal_marginal_relevance(
+            np.asarray(self.embeddings.embed_query(query)),
+            [vectors[parts].mean(axis=0) for _, parts in merged],
+            lambda_mult=self.mmr_lambda,
+            k=len(merged),
+        )
+        return pack([merged[i][0] for i in order], self.count_tokens, self.max_tokens, self.separator)
@@ -0,0 +1,122 @@
+import os
+import sqlite3
+import threading
+import time
+
+# SQLite limits the number of bound parameters per statement
+SQLITE_BATCH = 500
+
+
+def in_batches(items, size=SQLITE_BATCH):
+    """Splits `items` into lists that fit into one IN clause or executemany."""
+    items = list(items)
+    for i in range(0, len(items), size):
+        yield items[i : i + size]
+
+
+class DiskLRU():
+    """Size-bounded key/value store for blobs in a local SQLite file. When the
+    stored values exceed `max_bytes`, the least recently used ones are evicted."""
+
+    def __init__(self, path, max_bytes):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS entries ("
+            "key TEXT PRIMARY KEY, value BLOB NOT NULL, size INTEGER NOT NULL, last_used REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS entries_last_used ON entries(last_used)")
+        # Covering index, so the total size is summed without reading the blobs
+        self._conn.execute("CREATE INDEX IF NOT EXISTS entries_size ON entries(size)")
+        self.size = self._total_size()
+        self.hits = 0
+        self.misses = 0
+
+    def get_many(self, keys):
+        found = {}
+        with self._lock:
+            for batch in in_batches(set(keys)):
+                placeholders = ",".join("?" * len(batch))
+                rows = self._conn.execute(
+                    f"SELECT key, value FROM entries WHERE key IN ({placeholders})", batch
+                ).fetchall()
+                found.update(rows)
+                if rows:
+                    self._conn.execute(
+                        f"UPDATE entries SET last_used = ? WHERE key IN ({placeholders})",
+                        [time.time(), *batch],
+                    )
+            self.hits += len(found)
+            self.misses += len(set(keys)) - len(found)
+        return found
+
+    def get(self, key):
+        return self.get_many([key]).get(key)
+
+    def _total_size(self):
+        return self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+
+    def set_many(self, items):
+        now = time.time()
+        rows = [(key, value, len(value), now) for key, value in items.items()]
+        with self._lock:
+            # IMMEDIATE takes the write lock up front. Other processes write to
+            # the same file, so the total is only meaningful inside it
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._conn.executemany("INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?)", rows)
+                self.size = self._total_size()
+                if self.size > self.max_bytes:
+                    self._evict()
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def set(self, key, value):
+        self.set_many({key: value})
+
+    def delete(self, key):
+        with self._lock:
+            self._conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+            self.size = self._total_size()
+
+    def clear(self):
+        with self._lock:
+            self._conn.execute("DELETE FROM entries")
+            self.size = 0
+
+    def _evict(self):
+        # Runs inside set_many's transaction. Evict down to 90% so that we
+        # don't evict on every insert
+        target = int(self.max_bytes * 0.9)
+        evicted = []
+        cursor = self._conn.execute("SELECT key, size FROM entries ORDER BY last_used")
+        for key, size in cursor:
+            if self.size <= target:
+                break
+            evicted.append(key)
+            self.size -= size
+        cursor.close()
+        for batch in in_batches(evicted):
+            placeholders = ",".join("?" * len(batch))
+            self._conn.execute(f"DELETE FROM entries WHERE key IN ({placeholders})", batch)
+
+    def stats(self):
+        with self._lock:
+            entries = self._conn.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+            self.size = self._total_size()
+        lookups = self.hits + self.misses
+        return {
+            "entries": entries,
+            "bytes": self.size,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else None,
+        }
@@ -0,0 +1,178 @@
+import hashlib
+import os
+from array import array
+
+from langchain_core.embeddings import Embeddings
+
+from server.diskcache import DiskLRU
+
+EMBEDDING_CACHE_PATH = os.environ.get(
+    "EMBEDDING_CACHE_PATH", os.path.join("/", "server_data", "Cache", "embeddings.sqlite")
+)
+EMBEDDING_CACHE_MAX_MB = int(os.environ.get("EMBEDDING_CACHE_MAX_MB", "512"))
+
+# "torch" runs the sentence-transformers model as is, "onnx" runs an exported
+# and int8 quantized copy of it with ONNX Runtime on the CPU
+EMBEDDING_BACKEND = os.environ.get("EMBEDDING_BACKEND", "torch")
+EMBEDDING_BATCH_SIZE = int(os.environ.get("EMBEDDING_BATCH_SIZE", "32"))
+EMBEDDING_THREADS = int(os.environ.get("EMBEDDING_THREADS", "0"))  # 0: library default
+ONNX_MODEL_DIR = os.environ.get(
+    "ONNX_MODEL_DIR", os.path.join("/", "server_data", "Conf", "onnx")
+)
+
+
+def normalize_text(text):
+    return " ".join(text.split())
+
+
+def content_hash(text):
+    return hashlib.sha256(normalize_text(text).encode("utf-8")).hexdigest()
+
+
+class CachedEmbeddings(Embeddings):
+    """Wraps an embedding model and stores its vectors on disk, keyed by the
+    model name and the hash of the normalized text, so identical chunks are
+    only ever embedded once."""
+
+    def __init__(self, embeddings, namespace, cache=None):
+        self.embeddings = embeddings
+        self.namespace = namespace
+        self.cache = cache or DiskLRU(EMBEDDING_CACHE_PATH, EMBEDDING_CACHE_MAX_MB * 1024 * 1024)
+
+    def _key(self, kind, text):
+        return f"{self.namespace}:{kind}:{content_hash(text)}"
+
+    def _embed(self, kind, texts, embed):
+        keys = [self._key(kind, text) for text in texts]
+        found = self.cache.get_many(keys)
+
+        # Embed every missing text only once, even if it occurs several times
+        missing = {key: text for key, text in zip(keys, texts) if key not in found}
+        if missing:
+            vectors = embed(list(missing.values()))
+            computed = {key: array("f", vector).tobytes() for key, vector in zip(missing, vectors)}
+            self.cache.set_many(computed)
+            found.update(computed)
+
+        return [array("f", found[key]).tolist() for key in keys]
+
+    def embed_documents(self, texts):
+        return self._embed("doc", texts, self.embeddings.embed_documents)
+
+    def embed_query(self, text):
+        return self._embed("query", [text], lambda texts: [self.embeddings.embed_query(texts[0])])[0]
+
+    def stats(self):
+        return self.cache.stats()
+
+
+class OnnxEmbeddings(Embeddings):
+    """Runs a sentence-transformers model with mean pooling through ONNX Runtime.
+    The model is exported (and quantized to int8) once and kept in ONNX_MODEL_DIR."""
+
+    def __init__(
+        self,
+        model_name,
+        batch_size=EMBEDDING_BATCH_SIZE,
+        threads=EMBEDDING_THREADS,
+        quantize=True,
+        model_dir=ONNX_MODEL_DIR,
+    ):
+        try:
+            import onnxruntime
+            from transformers import AutoTokenizer
+        except ImportError as e:
+            raise ImportError(
+                "The onnx embedding backend needs `pip install optimum[onnxruntime]`"
+            ) from e
+
+        self.batch_size = batch_size
+        model_dir = os.path.join(model_dir, model_name.replace("/", "__"))
+        model_file = self._export(model_name, model_dir, quantize)
+
+        options = onnxruntime.SessionOptions()
+        if threads:
+            options.intra_op_num_threads = threads
+        self.session = onnxruntime.InferenceSession(
+            model_file, options, providers=["CPUExecutionProvider"]
+        )
+        self.input_names = [input.name for input in self.session.get_inputs()]
+        self.tokenizer = AutoTokenizer.from_pretrained(model_dir)
+
+    @staticmethod
+    def _export(model_name, model_dir, quantize):
+        model_file = os.path.join(model_dir, "model.onnx")
+        if not os.path.exists(model_file):
+            from optimum.onnxruntime import ORTModelForFeatureExtraction
+            from transformers import AutoTokenizer
+
+            print(f"Exporting {model_name} to ONNX in {model_dir}...")
+            ORTModelForFeatureExtraction.from_pretrained(model_name, export=True).save_pretrained(model_dir)
+            AutoTokenizer.from_pretrained(model_name).save_pretrained(model_dir)
+
+        if not quantize:
+            return model_file
+
+        quantized_file = os.path.join(model_dir, "model_int8.onnx")
+        if not os.path.exists(quantized_file):
+            from onnxruntime.quantization import QuantType, quantize_dynamic
+
+            print(f"Quantizing {model_file} to int8...")
+            quantize_dynamic(model_file, quantized_file, weight_type=QuantType.QInt8)
+        return quantized_file
+
+    def embed_documents(self, texts):
+        import numpy as np
+
+        # Batch texts of similar length together to keep padding low
+        order = sorted(range(len(texts)), key=lambda i: len(texts[i]))
+        vectors = [None] * len(texts)
+        for start in range(0, len(order), self.batch_size):
+            batch = order[start : start + self.batch_size]
+            encoded = self.tokenizer(
+                [texts[i] for i in batch],
+                padding=True,
+                truncation=True,
+                max_length=512,
+                return_tensors="np",
+            )
+            hidden = self.session.run(
+                None, {name: encoded[name] for name in self.input_names if name in encoded}
+            )[0]
+            mask = encoded["attention_mask"][..., None].astype(np.float32)
+            pooled = (hidden * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+            for i, vector in zip(batch, pooled.tolist()):
+                vectors[i] = vector
+        return vectors
+
+    def embed_query(self, text):
+        return self.embed_documents([text])[0]
+
+
+def make_embeddings(
+    model_name,
+    backend=EMBEDDING_BACKEND,
+    batch_size=EMBEDDING_BATCH_SIZE,
+    threads=EMBEDDING_THREADS,
+):
+    if backend == "onnx":
+        return OnnxEmbeddings(model_name, batch_size=batch_size, threads=threads)
+
+    if backend != "torch":
+        raise ValueError(f"Unknown embedding backend {backend}")
+
+    import torch
+    from langchain_community.embeddings import HuggingFaceEmbeddings
+
+    if threads:
+        torch.set_num_threads(threads)
+    return HuggingFaceEmbeddings(
+        model_name=model_name,
+        model_kwargs={"device": "cuda" if torch.cuda.is_available() else "cpu"},
+        encode_kwargs={"normalize_embeddings": False, "batch_size": batch_size},
+    )
+
+
+def cache_namespace(model_name, backend=EMBEDDING_BACKEND):
+    # Quantized vectors differ slightly, so they must not share cache entries
+    return model_name if backend == "torch" else f"{model_name}:{backend}-int8"
@@ -0,0 +1,189 @@
+import difflib
+import hashlib
+import os
+import re
+import threading
+import time
+from collections import namedtuple
+
+import numpy as np
+from sqlalchemy import select
+
+from server.formfill import STAMMDATEN_KEYS
+from server.schlagwortdb import models
+
+FIELD_MATCH_THRESHOLD = float(os.environ.get("FIELD_MATCH_THRESHOLD", "0.85"))
+# A similarity match must beat the best alias of any other key by this much,
+# short names like "Vertragsname" are otherwise close to several keys
+FIELD_MATCH_MARGIN = float(os.environ.get("FIELD_MATCH_MARGIN", "0.1"))
+FIELD_MATCHER_REFRESH_SECONDS = float(os.environ.get("FIELD_MATCHER_REFRESH_SECONDS", "300"))
+
+# Splits "Strasse_Hausnummer", "HausnummerZusatz" and "PLZ-Ort" into words
+TOKEN = re.compile(r"[A-ZÄÖÜ]?[a-zäöüß]+|[A-ZÄÖÜ]+(?![a-zäöüß])|\d+")
+UMLAUTS = str.maketrans({"ä": "ae", "ö": "oe", "ü": "ue", "ß": "ss"})
+
+# `keys` is a tuple of Stammdaten keys, several for fields like "PLZ_Ort"
+Match = namedtuple("Match", ["keys", "confidence", "method"])
+
+
+def normalize_field(name):
+    return " ".join(token.lower().translate(UMLAUTS) for token in TOKEN.findall(name))
+
+
+class FieldMatcher():
+    """Maps PDF form field names to Stammdaten keys without asking the LLM.
+
+    Every key is known under aliases: its own name, plus the names of the
+    Schlagwort with that name, its synonyms and the fields (Felder) linked to
+    it. A field matches with confidence 1.0 if its normalized name is an alias
+    or consists only of aliases ("PLZ_Ort"). Otherwise the best alias by
+    embedding or string similarity wins, with that similarity as confidence.
+    If the best alias of another key is within `margin` of it, the match is
+    "ambiguous". Only matches passing `accepted` should be filled without
+    confirmation by another source."""
+
+    def __init__(
+        self,
+        embedding_model,
+        session_factory,
+        keys=STAMMDATEN_KEYS,
+        threshold=FIELD_MATCH_THRESHOLD,
+        margin=FIELD_MATCH_MARGIN,
+    ):
+        self.embedding_model = embedding_model
+        self.session_factory = session_factory
+        self.keys = keys
+        self.threshold = threshold
+        self.margin = margin
+        self.generation = None
+        self._aliases = {}
+        self._alias_names = []
+        self._alias_vectors = None
+        self._matches = {}
+        self._loaded_at = None
+        self._lock = threading.Lock()
+        self.counts = {"exact": 0, "composite": 0, "embedding": 0, "string": 0, "ambiguous": 0, "cached": 0}
+
+    def _load_aliases(self):
+        aliases = {normalize_field(key): key for key in self.keys}
+
+        groups = {}
+        with self.session_factory() as session:
+            for pkey, schlagwort in session.execute(
+                select(models.Schlagwort.pkey, models.Schlagwort.schlagwort)
+            ):
+                groups.setdefault(pkey, set()).add(schlagwort)
+            for pkey, synonym in session.execute(
+                select(models.Synonym.schlagwort, models.Synonym.synonym)
+            ):
+                groups.setdefault(pkey, set()).add(synonym)
+            for pkey, feldname in session.execute(
+                select(models.Feld.schlagwort, models.Feld.feldname)
+            ):
+                groups.setdefault(pkey, set()).add(feldname)
+
+        for names in groups.values():
+            normalized = {normalize_field(name) for name in names if name}
+            key = next((aliases[name] for name in sorted(normalized) if name in aliases), None)
+            if key:
+                for name in normalized:
+                    aliases.setdefault(name, key)
+        aliases.pop("", None)
+        return aliases
+
+    def _refresh(self):
+        if self._loaded_at is not None and time.monotonic() - self._loaded_at < FIELD_MATCHER_REFRESH_SECONDS:
+            return
+        aliases = self._load_aliases()
+        generation = hashlib.sha256(repr(sorted(aliases.items())).encode("utf-8")).hexdigest()
+        if generation != self.generation:
+            names = list(aliases)
+            vectors = np.asarray(self.embedding_model.embed_documents(names), dtype=np.float32)
+            vectors /= np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+            self._aliases, self._alias_names, self._alias_vectors = aliases, names, vectors
+            self._matches = {}
+            self.generation = generation
+        self._loaded_at = time.monotonic()
+
+    def current_generation(self):
+        """Stamp of the alias vocabulary, changes when the tables change."""
+        with self._lock:
+            self._refresh()
+            return self.generation
+
+    def _match_exact(self, normalized):
+        if normalized in self._aliases:
+            return Match((self._aliases[normalized],), 1.0, "exact")
+        keys = [self._aliases.get(token) for token in normalized.split()]
+        if len(keys) > 1 and all(keys):
+            return Match(tuple(dict.fromkeys(keys)), 1.0, "composite")
+        return None
+
+    def _match_similar(self, normalized_fields):
+        vectors = np.asarray(self.embedding_model.embed_documents(normalized_fields), dtype=np.float32)
+        vectors /= np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+        similarities = vectors @ self._alias_vectors.T
+
+        matches = []
+        for normalized, row in zip(normalized_fields, similarities):
+            # Best similarity per key, by embedding or by string
+            best = {}
+            for name, similarity in zip(self._alias_names, row):
+                key = self._aliases[name]
+                ratio = difflib.SequenceMatcher(None, normalized, name).ratio()
+                method, score = ("string", ratio) if ratio > similarity else ("embedding", float(similarity))
+                if score > best.get(key, (0.0,))[0]:
+                    best[key] = (score, method)
+
+            ranked = sorted(best.items(), key=lambda item: item[1][0], reverse=True)
+            key, (score, method) = ranked[0]
+            runner_up = ranked[1][1][0] if len(ranked) > 1 else 0.0
+            if score - runner_up < self.margin:
+                method = "ambiguous"
+            matches.append(Match((key,), score, method))
+        return matches
+
+    def accepted(self, match):
+        return match.confidence >= self.threshold and match.method != "ambiguous"
+
+    def match(self, fields):
+        """Returns a Match for every field name in `fields`."""
+        with self._lock:
+            self._refresh()
+            result = {}
+            pending = {}
+            for field in fields:
+                normalized = normalize_field(field)
+                match = self._matches.get(normalized)
+                if match:
+                    self.counts["cached"] += 1
+                else:
+                    match = self._match_exact(normalized)
+                if match:
+                    result[field] = match
+                elif normalized:
+                    pending.setdefault(normalized, []).append(field)
+                else:
+                    result[field] = Match((), 0.0, "none")
+
+            if pending:
+                for normalized, match in zip(pending, self._match_similar(list(pending))):
+                    for field in pending[normalized]:
+                        result[field] = match
+
+            for field, match in result.items():
+                normalized = normalize_field(field)
+                if normalized not in self._matches and match.method != "none":
+                    self._matches[normalized] = match
+                    self.counts[match.method] += 1
+            return {field: result[field] for field in fields}
+
+    def stats(self):
+        with self._lock:
+            return {
+                "aliases": len(self._aliases),
+                "threshold": self.threshold,
+                "margin": self.margin,
+                "generation": self.generation,
+                **self.counts,
+            }
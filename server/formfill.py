@@ -0,0 +1,69 @@
+import io
+
+from pypdf import PdfWriter
+
+# Keys of the customer master data (Stammdaten) that form fields can be filled from
+STAMMDATEN_KEYS = [
+    "Anrede",
+    "Vorname",
+    "Name",
+    "Geburtsdatum",
+    "Geburtsort",
+    "Staatsangehoerigkeit",
+    "Vorwahl",
+    "Telefonnummer",
+    "Email",
+    "Familienstand",
+    "Strasse",
+    "Hausnummer",
+    "HausnummerZusatz",
+    "PLZ",
+    "Ort",
+]
+
+
+def build_stammdaten(kunde):
+    return {
+        "Anrede": kunde.anrede,
+        "Vorname": kunde.vorname,
+        "Name": kunde.name,
+        "Geburtsdatum": kunde.geburtsdatum,
+        "Geburtsort": kunde.geburtsort,
+        "Staatsangehoerigkeit": kunde.staatsangehoerigkeit,
+        "Vorwahl": kunde.vorwahl,
+        "Telefonnummer": kunde.telefonnummer,
+        "Email": kunde.email,
+        "Familienstand": kunde.familienstand,
+
+        "Strasse": kunde.adresse_obj.strasse,
+        "Hausnummer": kunde.adresse_obj.hausnummer,
+        "HausnummerZusatz": kunde.adresse_obj.hausnummerZusatz,
+        "PLZ": kunde.adresse_obj.plz,
+        "Ort": kunde.adresse_obj.ort,
+    }
+
+
+def field_values(mapping, stammdaten):
+    """Values for the form fields in `mapping` (field name -> tuple of
+    Stammdaten keys). Fields made of several keys, like "PLZ_Ort", get the
+    values joined by a space; fields without any value are left out."""
+    values = {}
+    for field, keys in mapping.items():
+        parts = [str(stammdaten[key]) for key in keys if stammdaten.get(key) not in (None, "")]
+        if parts:
+            values[field] = " ".join(parts)
+    return values
+
+
+def fill_form(reader, values):
+    """Returns the bytes of the PDF in `reader` with its form fields set to `values`."""
+    writer = PdfWriter()
+    writer.append(reader)
+    writer.set_need_appearances_writer()
+
+    for page in writer.pages:
+        writer.update_page_form_field_values(page, values, auto_regenerate=False)
+
+    bio = io.BytesIO()
+    writer.write(bio)
+    return bio.getvalue()
@@ -0,0 +1,142 @@
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+from typing import Any
+
+from langchain_core.callbacks import CallbackManagerForRetrieverRun
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+from sqlalchemy import select
+
+from server.embeddings import content_hash
+from server.schlagwortdb import models
+
+KEYWORD_INDEX_PATH = os.environ.get(
+    "KEYWORD_INDEX_PATH", os.path.join("/", "server_data", "KeywordIndex", "keywords.sqlite")
+)
+SYNONYM_REFRESH_SECONDS = float(os.environ.get("SYNONYM_REFRESH_SECONDS", "300"))
+RRF_K = 60
+
+WORD = re.compile(r"\w+")
+
+
+class KeywordIndex():
+    """BM25 index over the ingested chunks, using SQLite FTS5."""
+
+    def __init__(self, path=KEYWORD_INDEX_PATH):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS chunks USING fts5("
+            "id UNINDEXED, document_id UNINDEXED, text, metadata UNINDEXED, "
+            "tokenize = 'unicode61 remove_diacritics 2')"
+        )
+
+    def add(self, ids, texts, metadatas):
+        rows = [
+            (id, metadata.get("document_id"), text, json.dumps(metadata))
+            for id, text, metadata in zip(ids, texts, metadatas)
+        ]
+        with self._lock:
+            self._conn.execute("BEGIN")
+            self._conn.executemany("INSERT INTO chunks VALUES (?, ?, ?, ?)", rows)
+            self._conn.execute("COMMIT")
+
+    def delete_document(self, document_id):
+        with self._lock:
+            self._conn.execute("DELETE FROM chunks WHERE document_id = ?", (document_id,))
+
+    def has_document(self, document_id):
+        with self._lock:
+            return self._conn.execute(
+                "SELECT 1 FROM chunks WHERE document_id = ? LIMIT 1", (document_id,)
+            ).fetchone() is not None
+
+    def search(self, terms, k):
+        if not terms:
+            return []
+        # Quote every term, so user input can't inject FTS5 query syntax
+        query = " OR ".join('"' + term.replace('"', '""') + '"' for term in terms)
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT text, metadata FROM chunks WHERE chunks MATCH ? ORDER BY bm25(chunks) LIMIT ?",
+                (query, k),
+            ).fetchall()
+        return [Document(page_content=text, metadata=json.loads(metadata)) for text, metadata in rows]
+
+
+class SynonymExpander():
+    """Expands query words that are a Schlagwort or one of its synonyms to
+    the Schlagwort and all of its synonyms."""
+
+    def __init__(self, session_factory):
+        self.session_factory = session_factory
+        self._groups = {}
+        self._loaded_at = None
+        self._lock = threading.Lock()
+
+    def _load(self):
+        groups = {}
+        with self.session_factory() as session:
+            for schlagwort, synonym in session.execute(
+                select(models.Schlagwort.schlagwort, models.Synonym.synonym).outerjoin(
+                    models.Synonym, models.Synonym.schlagwort == models.Schlagwort.pkey
+                )
+            ):
+                group = groups.setdefault(schlagwort.lower(), {schlagwort})
+                if synonym:
+                    group.add(synonym)
+        for group in list(groups.values()):
+            for term in group:
+                groups[term.lower()] = group
+        return groups
+
+    def groups(self):
+        with self._lock:
+            if self._loaded_at is None or time.monotonic() - self._loaded_at > SYNONYM_REFRESH_SECONDS:
+                self._groups = self._load()
+                self._loaded_at = time.monotonic()
+            return self._groups
+
+    def expand(self, query):
+        groups = self.groups()
+        terms = []
+        for word in WORD.findall(query):
+            terms.append(word)
+            for term in groups.get(word.lower(), ()):
+                # Field-style terms like "Referenznummer_Vertrag" are searched as words
+                terms.extend(WORD.findall(term.replace("_", " ")))
+        return list(dict.fromkeys(terms))
+
+
+class HybridRetriever(BaseRetriever):
+    """Fuses dense (vector) and keyword (BM25) results with reciprocal rank fusion."""
+
+    vector_retriever: BaseRetriever
+    keyword_index: Any
+    expander: Any = None
+    k: int = 4
+    fetch_k: int = 10
+
+    def _get_relevant_documents(self, query: str, *, run_manager: CallbackManagerForRetrieverRun):
+        vector_docs = self.vector_retriever.invoke(
+            query, config={"callbacks": run_manager.get_child()}
+        )
+        terms = self.expander.expand(query) if self.expander else WORD.findall(query)
+        keyword_docs = self.keyword_index.search(terms, self.fetch_k)
+
+        scores = {}
+        docs = {}
+        for ranking in (vector_docs, keyword_docs):
+            for rank, doc in enumerate(ranking):
+                key = (doc.metadata.get("document_id"), content_hash(doc.page_content))
+                scores[key] = scores.get(key, 0.0) + 1.0 / (RRF_K + rank + 1)
+                docs.setdefault(key, doc)
+
+        best = sorted(scores, key=scores.get, reverse=True)[: self.k]
+        return [docs[key] for key in best]
@@ -0,0 +1,129 @@
+import os
+import queue
+import threading
+import time
+import traceback
+import uuid
+from collections import OrderedDict
+
+INGEST_WORKERS = int(os.environ.get("INGEST_WORKERS", "1"))
+INGEST_QUEUE_SIZE = int(os.environ.get("INGEST_QUEUE_SIZE", "16"))
+INGEST_JOB_HISTORY = int(os.environ.get("INGEST_JOB_HISTORY", "1000"))
+
+STAGES = ["extract", "chunk", "embed", "insert"]
+
+
+class IngestionJob():
+    def __init__(self, files, digests=None):
+        self.id = uuid.uuid4().hex
+        self.files = files
+        # sha256 of the files, if the caller hashed them while receiving them
+        self.digests = digests
+        self.status = "queued"
+        self.stages = {stage: {"done": 0, "total": None} for stage in STAGES}
+        self.result = None
+        self.error = None
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+
+    def progress(self, stage, done, total):
+        self.stages[stage] = {"done": done, "total": total}
+
+    def to_dict(self):
+        return {
+            "job_id": self.id,
+            "files": [os.path.basename(f) for f in self.files],
+            "status": self.status,
+            "stages": self.stages,
+            "result": self.result,
+            "error": self.error,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+        }
+
+
+class IngestionQueue():
+    """Runs VectorStore ingestion on background worker threads so uploads
+    never block the event loop. The queue is bounded; `submit` raises
+    `queue.Full` when it is, which callers should turn into backpressure."""
+
+    def __init__(
+        self,
+        vectorstore,
+        workers=INGEST_WORKERS,
+        max_queue=INGEST_QUEUE_SIZE,
+        max_history=INGEST_JOB_HISTORY,
+    ):
+        self.vectorstore = vectorstore
+        self.max_history = max_history
+        self.jobs = OrderedDict()
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._lock = threading.Lock()
+        self._threads = [
+            threading.Thread(target=self._work, name=f"ingest-{i}", daemon=True)
+            for i in range(workers)
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def submit(self, files, digests=None):
+        job = IngestionJob(files, digests)
+        self._queue.put_nowait(job)
+        with self._lock:
+            self.jobs[job.id] = job
+            # Forget the oldest finished jobs once the history is full
+            while len(self.jobs) > self.max_history:
+                oldest = next(iter(self.jobs.values()))
+                if oldest.status in ("queued", "running"):
+                    break
+                self.jobs.popitem(last=False)
+        return job
+
+    def get(self, job_id):
+        with self._lock:
+            return self.jobs.get(job_id)
+
+    def find_pending(self, digest):
+        """A queued or running job for a file with this sha256, or None."""
+        with self._lock:
+            for job in self.jobs.values():
+                if job.status in ("queued", "running") and digest in (job.digests or ()):
+                    return job
+        return None
+
+    def _work(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                break
+
+            job.status = "running"
+            job.started_at = time.time()
+            try:
+                job.result = self.vectorstore.injest_files(
+                    files=job.files, progress=job.progress, digests=job.digests
+                )
+                job.status = "done"
+            except Exception as e:
+                job.error = str(e)
+                job.status = "failed"
+                traceback.print_exc()
+            finally:
+                job.finished_at = time.time()
+                self._queue.task_done()
+
+    def shutdown(self):
+        for _ in self._threads:
+            self._queue.put(None)
+
+    def stats(self):
+        with self._lock:
+            statuses = [job.status for job in self.jobs.values()]
+        return {
+            "workers": len(self._threads),
+            "queue_depth": self._queue.qsize(),
+            "max_queue": self._queue.maxsize,
+            **{status: statuses.count(status) for status in ("queued", "running", "done", "failed")},
+        }
@@ -0,0 +1,51 @@
+import hashlib
+import json
+import os
+
+from server.diskcache import DiskLRU
+
+LLM_CACHE_PATH = os.environ.get(
+    "LLM_CACHE_PATH", os.path.join("/", "server_data", "Cache", "llm_results.sqlite")
+)
+LLM_CACHE_MAX_MB = int(os.environ.get("LLM_CACHE_MAX_MB", "64"))
+
+
+def _hash(value):
+    return hashlib.sha256(value.encode("utf-8")).hexdigest()
+
+
+def model_fingerprint(model_path):
+    # Hashing a multi-GB GGUF file on every start is too slow, a replaced
+    # model file changes its size or mtime anyway
+    stat = os.stat(model_path)
+    return f"{os.path.basename(model_path)}:{stat.st_size}:{int(stat.st_mtime)}"
+
+
+class LLMResultCache():
+    """Parsed results of deterministic LLM chains, stored on disk.
+
+    Entries are keyed by the model file, the prompt template, the chain inputs
+    and the sampling parameters, so changing any of them misses the cache.
+    Results are stored after output parsing, so a result that parsed once is
+    never regenerated."""
+
+    def __init__(self, model_path, params, cache=None):
+        self.namespace = _hash(
+            json.dumps([model_fingerprint(model_path), params], sort_keys=True, default=str)
+        )
+        self.cache = cache or DiskLRU(LLM_CACHE_PATH, LLM_CACHE_MAX_MB * 1024 * 1024)
+
+    def key(self, prompt, inputs):
+        template = _hash(prompt.pretty_repr())
+        inputs = _hash(json.dumps(inputs, sort_keys=True, ensure_ascii=False, default=str))
+        return f"{self.namespace}:{template}:{inputs}"
+
+    def get(self, key):
+        value = self.cache.get(key)
+        return json.loads(value) if value is not None else None
+
+    def set(self, key, result):
+        self.cache.set(key, json.dumps(result, ensure_ascii=False).encode("utf-8"))
+
+    def stats(self):
+        return self.cache.stats()
@@ -0,0 +1,82 @@
+import os
+import queue
+from contextlib import contextmanager
+from typing import Any
+
+from langchain_community.llms.llamacpp import LlamaCpp
+from langchain_core.language_models.llms import LLM
+
+LLM_POOL_SIZE = int(os.environ.get("LLM_POOL_SIZE", "1"))
+# Prompt tokens evaluated per decode step (LangChain's default of 8 is tiny)
+LLM_N_BATCH = int(os.environ.get("LLM_N_BATCH", "512"))
+
+
+class LlamaCppPool():
+    """A fixed number of llama.cpp contexts over the same GGUF file.
+
+    The weights are mmap'd, so on CPU all contexts share them through the page
+    cache and each one only adds its own KV cache. The cores are split evenly
+    between the contexts."""
+
+    def __init__(self, model_path, size=LLM_POOL_SIZE, **kwargs):
+        kwargs.setdefault("n_threads", max(1, (os.cpu_count() or 1) // size))
+        kwargs.setdefault("n_batch", LLM_N_BATCH)
+        self.model_path = model_path
+        self.contexts = [
+            LlamaCpp(model_path=model_path, use_mmap=True, **kwargs) for _ in range(size)
+        ]
+        self._free = queue.Queue()
+        for llm in self.contexts:
+            self._free.put(llm)
+
+    @property
+    def size(self):
+        return len(self.contexts)
+
+    @property
+    def sampling_params(self):
+        # Same for every context
+        llm = self.contexts[0]
+        return {**llm._default_params, "seed": llm.seed}
+
+    @contextmanager
+    def checkout(self):
+        llm = self._free.get()
+        try:
+            yield llm
+        finally:
+            self._free.put(llm)
+
+    def stats(self):
+        return {"contexts": self.size, "idle": self._free.qsize()}
+
+
+class PooledLlamaCpp(LLM):
+    """LangChain LLM that runs every call on a free context of a LlamaCppPool,
+    so the chains don't need to know about the pool."""
+
+    pool: Any
+    prefix_cache: Any = None
+
+    @property
+    def _llm_type(self):
+        return "llamacpp-pool"
+
+    def _call(self, prompt, stop=None, run_manager=None, **kwargs):
+        with self.pool.checkout() as llm:
+            if self.prefix_cache:
+                self.prefix_cache.prepare(llm.client, prompt)
+            return llm._call(prompt, stop=stop, run_manager=run_manager, **kwargs)
+
+    def _stream(self, prompt, stop=None, run_manager=None, **kwargs):
+        with self.pool.checkout() as llm:
+            if self.prefix_cache:
+                self.prefix_cache.prepare(llm.client, prompt)
+            yield from llm._stream(prompt, stop=stop, run_manager=run_manager, **kwargs)
+
+    def get_num_tokens(self, text):
+        return self.pool.contexts[0].get_num_tokens(text)
+
+    def count_tokens(self, text):
+        # get_num_tokens counts a BOS token, which a piece of a prompt doesn't have
+        return len(self.pool.contexts[0].client.tokenize(text.encode("utf-8"), add_bos=False))
@@ -0,0 +1,325 @@
+import fcntl
+import json
+import os
+import threading
+import uuid
+from contextlib import contextmanager
+
+import numpy as np
+from langchain_core.documents import Document
+from langchain_core.vectorstores import VectorStore
+
+IVF_THRESHOLD = int(os.environ.get("VECTORDB_IVF_THRESHOLD", "20000"))
+IVF_NPROBE = int(os.environ.get("VECTORDB_IVF_NPROBE", "8"))
+
+
+def _normalize(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.clip(norms, 1e-12, None)
+
+
+def _kmeans(vectors, n_clusters, iterations=10, seed=0):
+    rng = np.random.default_rng(seed)
+    centroids = vectors[rng.choice(len(vectors), n_clusters, replace=False)]
+    for _ in range(iterations):
+        assignment = np.argmax(vectors @ centroids.T, axis=1)
+        for c in range(n_clusters):
+            members = vectors[assignment == c]
+            if len(members):
+                centroids[c] = members.mean(axis=0)
+        centroids = _normalize(centroids)
+    return centroids
+
+
+class LocalVectorIndex(VectorStore):
+    """In-process vector index for deployments without a pgvector server.
+
+    Normalized float32 vectors are appended to `vectors.f32` and memory-mapped
+    for search, texts and metadata go to `chunks.jsonl` in the same row order.
+    Small collections are searched exhaustively. Once a collection has more than
+    `ivf_threshold` live rows, an IVF index (k-means centroids plus one row
+    list per centroid) is built, and only the `nprobe` nearest lists are scanned.
+    Scores are cosine distances, like the default PGVector distance strategy.
+    """
+
+    def __init__(self, path, embedding_function, ivf_threshold=IVF_THRESHOLD, nprobe=IVF_NPROBE):
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.embedding_function = embedding_function
+        self.ivf_threshold = ivf_threshold
+        self.nprobe = nprobe
+        self._lock = threading.RLock()
+        self._state_mtime = None
+        self._load()
+
+    @property
+    def embeddings(self):
+        return self.embedding_function
+
+    def _file(self, name):
+        return os.path.join(self.path, name)
+
+    @contextmanager
+    def _write_lock(self):
+        # Serializes writers across processes (server, process_document, ...)
+        with self._lock, open(self._file("lock"), "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                self._reload_if_changed()
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _load(self):
+        state = {"dim": None, "rows": 0, "chunks_bytes": 0, "deleted": []}
+        if os.path.exists(self._file("index.json")):
+            with open(self._file("index.json")) as f:
+                state = json.load(f)
+            self._state_mtime = os.stat(self._file("index.json")).st_mtime_ns
+
+        self.dim = state["dim"]
+        self.chunks_bytes = state["chunks_bytes"]
+        rows = state["rows"]
+        self.ids, self.texts, self.metadatas = [], [], []
+        if rows:
+            with open(self._file("chunks.jsonl"), encoding="utf-8") as f:
+                for line, _ in zip(f, range(rows)):
+                    chunk = json.loads(line)
+                    self.ids.append(chunk["id"])
+                    self.texts.append(chunk["text"])
+                    self.metadatas.append(chunk["metadata"])
+        self.alive = np.ones(rows, dtype=bool)
+        self.alive[state["deleted"]] = False
+        self.id_rows = {id: row for row, id in enumerate(self.ids) if self.alive[row]}
+        self._map_vectors()
+        self._load_ivf()
+
+    def _reload_if_changed(self):
+        path = self._file("index.json")
+        if os.path.exists(path) and os.stat(path).st_mtime_ns != self._state_mtime:
+            self._load()
+
+    def _map_vectors(self):
+        rows = len(self.ids)
+        if rows:
+            self.vectors = np.memmap(self._file("vectors.f32"), dtype=np.float32, mode="r", shape=(rows, self.dim))
+        else:
+            self.vectors = np.empty((0, self.dim or 0), dtype=np.float32)
+
+    def _save_state(self):
+        # index.json is written last, so rows appended by an interrupted write are ignored
+        tmp = self._file("index.json.tmp")
+        with open(tmp, "w") as f:
+            json.dump(
+                {
+                    "dim": self.dim,
+                    "rows": len(self.ids),
+                    "chunks_bytes": self.chunks_bytes,
+                    "deleted": np.flatnonzero(~self.alive).tolist(),
+                },
+                f,
+            )
+        os.replace(tmp, self._file("index.json"))
+        self._state_mtime = os.stat(self._file("index.json")).st_mtime_ns
+
+    def _load_ivf(self):
+        self.centroids, self.lists = None, None
+        if os.path.exists(self._file("ivf.npz")):
+            ivf = np.load(self._file("ivf.npz"))
+            if int(ivf["rows"]) <= len(self.ids):
+                self.centroids = ivf["centroids"]
+                assignment = ivf["assignment"]
+                # Rows added after the index was built go to their nearest list
+                if len(assignment) < len(self.ids):
+                    new = np.asarray(self.vectors[len(assignment):])
+                    assignment = np.concatenate([assignment, np.argmax(new @ self.centroids.T, axis=1)])
+                self.lists = [np.flatnonzero(assignment == c) for c in range(len(self.centroids))]
+                self._ivf_rows = int(ivf["rows"])
+
+    def build_ivf(self):
+        with self._write_lock():
+            live = np.flatnonzero(self.alive)
+            n_lists = max(1, min(int(4 * np.sqrt(len(live))), len(live)))
+            sample = live if len(live) <= 256 * n_lists else np.random.default_rng(0).choice(live, 256 * n_lists, replace=False)
+            centroids = _kmeans(np.asarray(self.vectors[np.sort(sample)]), n_lists)
+            assignment = np.concatenate([
+                np.argmax(np.asarray(self.vectors[i : i + 65536]) @ centroids.T, axis=1)
+                for i in range(0, len(self.ids), 65536)
+            ])
+            with open(self._file("ivf.npz.tmp"), "wb") as f:
+                np.savez(f, centroids=centroids, assignment=assignment, rows=len(self.ids))
+            os.replace(self._file("ivf.npz.tmp"), self._file("ivf.npz"))
+            self._load_ivf()
+
+    def _needs_ivf(self):
+        live = int(self.alive.sum())
+        if live < self.ivf_threshold:
+            return False
+        # Rebuild when the collection has grown by half since the last build
+        return self.centroids is None or len(self.ids) > 1.5 * self._ivf_rows
+
+    def add_embeddings(self, texts, embeddings, metadatas=None, ids=None, **kwargs):
+        texts = list(texts)
+        if not texts:
+            return []
+        ids = ids or [str(uuid.uuid4()) for _ in texts]
+        metadatas = metadatas or [{} for _ in texts]
+        vectors = _normalize(embeddings)
+
+        with self._write_lock():
+            self.dim = self.dim or vectors.shape[1]
+            for id in ids:
+                if id in self.id_rows:
+                    self.alive[self.id_rows.pop(id)] = False
+
+            # Drop anything an interrupted write left behind the committed rows
+            with open(self._file("vectors.f32"), "ab") as f:
+                f.truncate(len(self.ids) * self.dim * 4)
+                f.write(vectors.tobytes())
+            with open(self._file("chunks.jsonl"), "ab") as f:
+                f.truncate(self.chunks_bytes)
+                for id, text, metadata in zip(ids, texts, metadatas):
+                    f.write((json.dumps({"id": id, "text": text, "metadata": metadata}) + "\n").encode("utf-8"))
+                self.chunks_bytes = f.tell()
+
+            start = len(self.ids)
+            self.ids.extend(ids)
+            self.texts.extend(texts)
+            self.metadatas.extend(metadatas)
+            self.alive = np.concatenate([self.alive, np.ones(len(ids), dtype=bool)])
+            self.id_rows.update({id: start + i for i, id in enumerate(ids)})
+            self._map_vectors()
+            if self.centroids is not None:
+                for row, c in enumerate(np.argmax(vectors @ self.centroids.T, axis=1), start):
+                    self.lists[c] = np.append(self.lists[c], row)
+            self._save_state()
+
+        if self._needs_ivf():
+            self.build_ivf()
+        return ids
+
+    def add_texts(self, texts, metadatas=None, ids=None, **kwargs):
+        texts = list(texts)
+        embeddings = self.embedding_function.embed_documents(texts)
+        return self.add_embeddings(texts, embeddings, metadatas=metadatas, ids=ids)
+
+    def delete(self, ids=None, **kwargs):
+        with self._write_lock():
+            for id in ids or []:
+                if id in self.id_rows:
+                    self.alive[self.id_rows.pop(id)] = False
+            self._save_state()
+
+            # Compact once a quarter of the rows are dead
+            if len(self.ids) and (~self.alive).sum() > len(self.ids) / 4:
+                self._compact()
+        return True
+
+    def _compact(self):
+        live = np.flatnonzero(self.alive)
+        with open(self._file("vectors.f32.tmp"), "wb") as f:
+            for i in range(0, len(live), 65536):
+                f.write(np.asarray(self.vectors[live[i : i + 65536]]).tobytes())
+        with open(self._file("chunks.jsonl.tmp"), "wb") as f:
+            for row in live:
+                chunk = {"id": self.ids[row], "text": self.texts[row], "metadata": self.metadatas[row]}
+                f.write((json.dumps(chunk) + "\n").encode("utf-8"))
+            self.chunks_bytes = f.tell()
+
+        os.replace(self._file("vectors.f32.tmp"), self._file("vectors.f32"))
+        os.replace(self._file("chunks.jsonl.tmp"), self._file("chunks.jsonl"))
+        self.ids = [self.ids[row] for row in live]
+        self.texts = [self.texts[row] for row in live]
+        self.metadatas = [self.metadatas[row] for row in live]
+        self.alive = np.ones(len(live), dtype=bool)
+        self.id_rows = {id: row for row, id in enumerate(self.ids)}
+        self._map_vectors()
+        self._save_state()
+        if os.path.exists(self._file("ivf.npz")):
+            os.remove(self._file("ivf.npz"))
+        self.centroids, self.lists = None, None
+
+    def ids_with_prefix(self, prefix):
+        with self._lock:
+            self._reload_if_changed()
+            return [id for id in self.id_rows if id.startswith(prefix)]
+
+    def find_metadata(self, key, value):
+        # Linear scan, fine next to the cost of ingesting a document
+        with self._lock:
+            self._reload_if_changed()
+            for row in self.id_rows.values():
+                if self.metadatas[row].get(key) == value:
+                    return self.metadatas[row]
+        return None
+
+    def get_metadata(self, id):
+        with self._lock:
+            row = self.id_rows.get(id)
+            return self.metadatas[row] if row is not None else None
+
+    def generation(self):
+        # Changes whenever any process writes to the index
+        with self._lock:
+            self._reload_if_changed()
+            return self._state_mtime
+
+    def count(self):
+        with self._lock:
+            self._reload_if_changed()
+            return len(self.id_rows)
+
+    def _search_rows(self, query):
+        # Exhaustive search, or only the rows in the IVF lists nearest to the query
+        if self.centroids is None:
+            rows = np.flatnonzero(self.alive)
+            return rows, (np.asarray(self.vectors) @ query)[rows]
+        probes = np.argsort(-(self.centroids @ query))[: self.nprobe]
+        rows = np.concatenate([self.lists[c] for c in probes])
+        rows = rows[self.alive[rows]]
+        return rows, np.asarray(self.vectors[rows]) @ query
+
+    def similarity_search_with_score_by_vector(self, embedding, k=4, filter=None, **kwargs):
+        with self._lock:
+            self._reload_if_changed()
+            if not self.id_rows:
+                return []
+            rows, similarities = self._search_rows(_normalize(embedding))
+
+            if filter or k >= len(rows):
+                order = np.argsort(-similarities)
+            else:
+                top = np.argpartition(-similarities, k)[:k]
+                order = top[np.argsort(-similarities[top])]
+
+            results = []
+            for i in order:
+                row = rows[i]
+                metadata = self.metadatas[row]
+                if filter and any(metadata.get(key) != value for key, value in filter.items()):
+                    continue
+                doc = Document(page_content=self.texts[row], metadata=metadata)
+                results.append((doc, 1.0 - float(similarities[i])))
+                if len(results) == k:
+                    break
+            return results
+
+    def similarity_search_by_vector(self, embedding, k=4, filter=None, **kwargs):
+        return [doc for doc, _ in self.similarity_search_with_score_by_vector(embedding, k=k, filter=filter)]
+
+    def similarity_search_with_score(self, query, k=4, filter=None, **kwargs):
+        embedding = self.embedding_function.embed_query(query)
+        return self.similarity_search_with_score_by_vector(embedding, k=k, filter=filter)
+
+    def similarity_search(self, query, k=4, filter=None, **kwargs):
+        return [doc for doc, _ in self.similarity_search_with_score(query, k=k, filter=filter)]
+
+    def _select_relevance_score_fn(self):
+        return self._cosine_relevance_score_fn
+
+    @classmethod
+    def from_texts(cls, texts, embedding, metadatas=None, ids=None, path=None, **kwargs):
+        store = cls(path, embedding, **kwargs)
+        store.add_texts(texts, metadatas=metadatas, ids=ids)
+        return store
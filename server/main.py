@@ -1,23 +1,44 @@
-import io
 import json
 import os
+import queue
 import time
 from contextlib import asynccontextmanager
-from typing import Optional
+from typing import List, Optional
 
 import torch
-from fastapi import Depends, FastAPI, File, HTTPException, Query, Response, UploadFile
-from fastapi.responses import FileResponse
+from fastapi import Body, Depends, FastAPI, File, HTTPException, Query, Request, Response, UploadFile
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import FileResponse, JSONResponse, StreamingResponse
 from langchain.chains.conversational_retrieval.base import ConversationalRetrievalChain
+from langchain.chains.conversational_retrieval.prompts import CONDENSE_QUESTION_PROMPT
+from langchain.chains.question_answering.stuff_prompt import PROMPT as QA_PROMPT
 from langchain.memory.buffer import ConversationBufferMemory
-from langchain_community.llms.llamacpp import LlamaCpp
 from langchain_core.exceptions import OutputParserException
-from langchain_core.output_parsers import JsonOutputParser, StrOutputParser
+from langchain_core.output_parsers import JsonOutputParser
 from langchain_core.prompts import ChatPromptTemplate
-from pypdf import PdfReader, PdfWriter
-
+from pypdf import PdfReader
+from sqlalchemy import select
+from sqlalchemy.orm import selectinload
+
+from server.answer_cache import SemanticAnswerCache
+from server.bulkfill import bulk_fill
+from server.context import CONTEXT_CANDIDATES, ContextAssembler
+from server.field_matcher import FieldMatcher
+from server.formfill import STAMMDATEN_KEYS, build_stammdaten, field_values, fill_form
+from server.ingestion import IngestionQueue
+from server.llm_cache import LLMResultCache
+from server.llmpool import LlamaCppPool, PooledLlamaCpp
+from server.pdf_cache import FilledPdfCache, filled_pdf_key
+from server.prefix_cache import PrefixCache
+from server.rerank import RERANK, RERANK_CANDIDATES, CrossEncoderReranker, RerankingRetriever
+from server.scheduler import BATCH, INTERACTIVE, InferenceCancelled, InferenceScheduler, InferenceTimeout
 from server.schlagwortdb import models
+from server.schlagwortdb.async_database import AsyncSessionLocal
 from server.schlagwortdb.database import SessionLocal, engine
+from server.schlagwortdb.migrations import migrate
+from server.sessions import SessionStore
+from server.streaming import serialize_document, stream_cached, stream_chain
+from server.uploads import UPLOAD_MAX_MB, UploadLimitMiddleware, UploadTooLarge, receive_upload
 from server.vectordb import VectorStore
 
 MODEL_PATH = os.path.join(
@@ -33,15 +54,21 @@ async def lifespan(app: FastAPI):
     print("Is CUDA available? ", torch.cuda.is_available())
     print(f"Loading {MODEL_PATH} LlamaCpp model...")
     start = time.time()
-    app.state.llm = LlamaCpp(
-        model_path=MODEL_PATH,
+    # Requests are spread over a pool of contexts that share the mmap'd weights
+    app.state.llm_pool = LlamaCppPool(
+        MODEL_PATH,
         temperature=0.5,
         verbose=True,
         n_ctx=2048,
         n_gpu_layers=-1,
     )
+    app.state.prefix_cache = PrefixCache()
+    for prompt in (FILL_PROMPT, CONDENSE_QUESTION_PROMPT, QA_PROMPT):
+        app.state.prefix_cache.register(prompt)
+    app.state.llm = PooledLlamaCpp(pool=app.state.llm_pool, prefix_cache=app.state.prefix_cache)
+    app.state.llm_cache = LLMResultCache(MODEL_PATH, app.state.llm_pool.sampling_params)
     end = time.time()
-    print(f"LlamaCpp model loaded in {end - start} seconds")
+    print(f"LlamaCpp model loaded into {app.state.llm_pool.size} contexts in {end - start} seconds")
 
     print("Loading VectorStore...")
     start = time.time()
@@ -49,8 +76,22 @@ async def lifespan(app: FastAPI):
     end = time.time()
     print(f"VectorStore loaded in {end - start} seconds")
 
+    # Cross-encoder between retrieval and the LLM, loaded on first use
+    app.state.reranker = CrossEncoderReranker() if RERANK else None
+    app.state.scheduler = InferenceScheduler(workers=app.state.llm_pool.size)
+    app.state.sessions = SessionStore(get_chain)
+    app.state.ingestion = IngestionQueue(app.state.vectorstore)
+    app.state.answer_cache = SemanticAnswerCache(
+        app.state.vectorstore.embedding_model, app.state.vectorstore.generation
+    )
+    app.state.field_matcher = FieldMatcher(app.state.vectorstore.embedding_model, SessionLocal)
+    app.state.pdf_cache = FilledPdfCache()
+
     yield
 
+    app.state.ingestion.shutdown()
+    app.state.scheduler.shutdown()
+
 
 def get_db():
     db = SessionLocal()
@@ -60,12 +101,19 @@ def get_db():
         db.close()
 
 
+async def get_async_db():
+    async with AsyncSessionLocal() as db:
+        yield db
+
+
 # models.Base.metadata.drop_all(bind=engine)
-models.Base.metadata.create_all(bind=engine)
+migrate(engine)
 app = FastAPI(lifespan=lifespan)
+app.add_middleware(UploadLimitMiddleware, paths=["/upload-file/", "/fill-pdf/"])
 
 with open(os.path.join(os.path.dirname(__file__), "PROMPT.txt"), "r") as f:
     PROMPT = f.read()
+FILL_PROMPT = ChatPromptTemplate.from_template(PROMPT)
 
 with open(os.path.join(os.path.dirname(__file__), "context.json"), "r") as f:
     context = json.loads(f.read())
@@ -75,16 +123,38 @@ for dir in ["_Dokumentendump_", "Archiv", "Conf", "Logs"]:
     os.makedirs(dir, exist_ok=True)
 
 
+def llm_busy():
+    return HTTPException(
+        503,
+        {"error": "Too many requests waiting for the LLM, please retry later"},
+        headers={"Retry-After": "10"},
+    )
+
+
+async def run_llm(fn, priority, request=None):
+    # Runs fn(callbacks) on the inference scheduler, off the event loop
+    try:
+        return await app.state.scheduler.run(fn, priority=priority, request=request)
+    except queue.Full:
+        raise llm_busy()
+    except InferenceTimeout:
+        raise HTTPException(504, {"error": "LLM request timed out"})
+    except InferenceCancelled:
+        raise HTTPException(499, {"error": "Client closed request"})
+
+
 @app.get("/schlagworte/")
-def get_schlagworte(db=Depends(get_db)):
-    return db.query(models.Schlagwort).all()
+async def get_schlagworte(db=Depends(get_async_db)):
+    return (await db.execute(select(models.Schlagwort))).scalars().all()
 
 
 @app.post("/schlagworte/create/")
-def create_schlagwort(schlagwort: str, db=Depends(get_db)):
+async def create_schlagwort(schlagwort: str, db=Depends(get_async_db)):
     schlagwort = models.Schlagwort(schlagwort=schlagwort)
     db.add(schlagwort)
-    db.commit()
+    await db.commit()
+    # Loads the server defaults of the new row
+    await db.refresh(schlagwort)
     return schlagwort
 
 
@@ -93,40 +163,101 @@ def hello_world():
     return {"hello": "world"}
 
 
+@app.get("/metrics/")
+def metrics():
+    return {
+        "llm_pool": app.state.llm_pool.stats(),
+        "llm_scheduler": app.state.scheduler.stats(),
+        "prefix_cache": app.state.prefix_cache.stats(),
+        "llm_cache": app.state.llm_cache.stats(),
+        "sessions": app.state.sessions.stats(),
+        "ingestion": app.state.ingestion.stats(),
+        "embedding_cache": app.state.vectorstore.embedding_model.stats(),
+        "answer_cache": app.state.answer_cache.stats(),
+        "field_matcher": app.state.field_matcher.stats(),
+        "filled_pdf_cache": app.state.pdf_cache.stats(),
+        "reranker": app.state.reranker.stats() if app.state.reranker else None,
+    }
+
+
 @app.post("/upload-file/")
 async def upload_file(file: UploadFile = File(...)):
     try:
-        # Ensure the directory for storing files exists, if not create it
-        os.makedirs("uploads", exist_ok=True)
-
-        # Save the uploaded file to the "uploads" directory with the original name
-        with open(os.path.join("/", "server_data", "uploads", file.filename), "wb") as buffer:
-            buffer.write(await file.read())
-        app.state.vectorstore.injest_files(files=["/server_data/uploads/" + file.filename])
-
-        return Response(
-            content=f"File {file.filename} uploaded successfully", status_code=200
-        )
+        upload = await receive_upload(file)
+    except UploadTooLarge as e:
+        raise HTTPException(413, {"error": str(e)})
     except Exception as e:
         return Response(content=f"Failed to upload file: {e}", status_code=500)
 
+    async with upload:
+        # Identical files are neither stored nor extracted and embedded again
+        job = app.state.ingestion.find_pending(upload.sha256)
+        if job:
+            return JSONResponse({**job.to_dict(), "duplicate": True}, status_code=200)
+        document_id = await run_in_threadpool(app.state.vectorstore.find_by_file_hash, upload.sha256)
+        if document_id:
+            return {"document_id": document_id, "file_hash": upload.sha256, "duplicate": True}
+
+        # Ingestion runs in the background, the client polls the job status.
+        # The file must exist before a worker can pick up the job
+        try:
+            job = app.state.ingestion.submit([upload.commit()], digests=[upload.sha256])
+        except queue.Full:
+            upload.discard()
+            raise HTTPException(
+                429,
+                {"error": "Too many files waiting for ingestion, please retry later"},
+                headers={"Retry-After": "30"},
+            )
+
+    return JSONResponse(job.to_dict(), status_code=202)
+
+
+@app.get("/upload-file/{job_id}")
+def upload_status(job_id: str):
+    job = app.state.ingestion.get(job_id)
+    if not job:
+        raise HTTPException(404, {"error": "Job not found"})
+    return job.to_dict()
+
+
+@app.delete("/documents/{document_id}")
+def delete_document(document_id: str):
+    deleted = app.state.vectorstore.delete_document(document_id)
+    if not deleted:
+        raise HTTPException(404, {"error": "Document not found"})
+    return {"document_id": document_id, "chunks": deleted}
+
 
 @app.post("/fill-pdf/")
-async def fill_pdf(file: UploadFile = File(...), context: dict = {}):
-    bio = io.BytesIO(file.file.read())
-    reader = PdfReader(bio)
+async def fill_pdf(
+    request: Request,
+    file: UploadFile = File(...),
+    context: dict = {},
+    use_cache: bool = Query(True),
+):
+    if file.size is not None and file.size > UPLOAD_MAX_MB * 1024 * 1024:
+        raise HTTPException(413, {"error": str(UploadTooLarge(UPLOAD_MAX_MB * 1024 * 1024))})
+    # The upload is already spooled to a temporary file, pypdf reads it from there
+    reader = PdfReader(file.file)
     fields = reader.get_fields()
 
-    prompt = ChatPromptTemplate.from_template(PROMPT)
     output = JsonOutputParser()
-    chain = prompt | app.state.llm | output
+    chain = FILL_PROMPT | app.state.llm | output
 
     data = {
         "fields": {name: field.field_type for name, field in fields.items()},
-        "context": json.dumps(context),
+        "context": json.dumps(context, sort_keys=True),
     }
+    cache_key = app.state.llm_cache.key(FILL_PROMPT, data) if use_cache else None
+    result = await run_in_threadpool(app.state.llm_cache.get, cache_key) if cache_key else None
     try:
-        result = chain.invoke(data)
+        if result is None:
+            result = await run_llm(
+                lambda callbacks: chain.invoke(data, config={"callbacks": callbacks}), BATCH, request
+            )
+            if cache_key:
+                await run_in_threadpool(app.state.llm_cache.set, cache_key, result)
     except OutputParserException as e:
         raise HTTPException(
             500,
@@ -138,23 +269,14 @@ async def fill_pdf(file: UploadFile = File(...), context: dict = {}):
         )
 
     # Write results to PDF
-    writer = PdfWriter()
-    writer.append(reader)
-    writer.set_need_appearances_writer()
-
-    for page in writer.pages:
-        writer.update_page_form_field_values(page, result, auto_regenerate=False)
-
-    bio = io.BytesIO()
-    writer.write(bio)
-    filled_pdf = bio.getvalue()
+    filled_pdf = fill_form(reader, result)
 
     filled_filename = file.filename.replace(".pdf", "_filled.pdf")
     headers = {"Content-Disposition": f"attachment; filename={filled_filename}"}
     return Response(filled_pdf, media_type="application/pdf", headers=headers)
 
 
-def get_field_mapping(keywords: dict, fields: dict):
+async def get_field_mapping(keywords: list, fields: list, use_cache: bool = True):
     prompt = ChatPromptTemplate.from_messages(
         [
             ("system", """
@@ -167,19 +289,70 @@ def get_field_mapping(keywords: dict, fields: dict):
              ("user", f"{fields}"),
         ]
     )
-    output = StrOutputParser()  # JsonOutputParser()
+    output = JsonOutputParser()
     chain = prompt | app.state.llm | output
 
     data = {"keywords": ", ".join(keywords), "words": ",".join(fields)}
-    result = chain.invoke(data)
+    cache_key = app.state.llm_cache.key(prompt, data) if use_cache else None
+    result = await run_in_threadpool(app.state.llm_cache.get, cache_key) if cache_key else None
+    if result is None:
+        result = await run_llm(
+            lambda callbacks: chain.invoke(data, config={"callbacks": callbacks}), BATCH
+        )
+        if cache_key:
+            await run_in_threadpool(app.state.llm_cache.set, cache_key, result)
     return result
 
 
+async def map_fields(fields, llm_fallback=True, use_cache=True):
+    """Maps form fields to tuples of Stammdaten keys. Returns the mapping and
+    whether it is complete, i.e. the LLM fallback didn't fail. `use_cache`
+    applies to the LLM fallback's result cache."""
+    matches = await run_in_threadpool(app.state.field_matcher.match, fields)
+    field_mapping = {
+        field: match.keys
+        for field, match in matches.items()
+        if app.state.field_matcher.accepted(match)
+    }
+
+    # Only the fields the matcher isn't sure about are left to the LLM
+    complete = True
+    uncertain = [field for field in fields if field not in field_mapping]
+    if uncertain and llm_fallback:
+        try:
+            result = await get_field_mapping(STAMMDATEN_KEYS, uncertain, use_cache=use_cache)
+        except (OutputParserException, HTTPException) as e:
+            print(f"LLM field mapping failed, leaving {len(uncertain)} fields empty: {e}")
+            result = {}
+            complete = False
+        if isinstance(result, dict):
+            field_mapping.update(
+                {
+                    field: (key,)
+                    for field, key in result.items()
+                    if field in uncertain and key in STAMMDATEN_KEYS
+                }
+            )
+    return field_mapping, complete
+
+
+def etag_matches(request, etag):
+    if_none_match = request.headers.get("if-none-match", "")
+    return any(
+        tag.strip().removeprefix("W/") in (etag, "*") for tag in if_none_match.split(",")
+    )
+
+
 @app.get("/get-document/")
 async def get_document(
-    doc_id: int, kunde_id: Optional[int] = Query(None), db=Depends(get_db)
+    request: Request,
+    doc_id: int,
+    kunde_id: Optional[int] = Query(None),
+    llm_fallback: bool = Query(True),
+    use_cache: bool = Query(True),
+    db=Depends(get_async_db),
 ):
-    doc = db.query(models.DokumentLookup).get(doc_id)
+    doc = await db.get(models.DokumentLookup, doc_id)
     if not doc:
         raise HTTPException(404, {"error": "Document not found"})
 
@@ -189,68 +362,84 @@ async def get_document(
         return FileResponse(doc_file, filename=doc.docOrigName)
     
 
-    kunde = db.query(models.Kunde).get(kunde_id)
+    kunde = await db.get(models.Kunde, kunde_id, options=[selectinload(models.Kunde.adresse_obj)])
     if not kunde:
         raise HTTPException(404, {"error": "Kunde not found"})
 
-    stammdaten = {
-        "Anrede": kunde.anrede,
-        "Vorname": kunde.vorname,
-        "Name": kunde.name,
-        "Geburtsdatum": kunde.geburtsdatum,
-        "Geburtsort": kunde.geburtsort,
-        "Staatsangehoerigkeit": kunde.staatsangehoerigkeit,
-        "Vorwahl": kunde.vorwahl,
-        "Telefonnummer": kunde.telefonnummer,
-        "Email": kunde.email,
-        "Familienstand": kunde.familienstand,
-
-        "Strasse": kunde.adresse_obj.strasse,
-        "Hausnummer": kunde.adresse_obj.hausnummer,
-        "HausnummerZusatz": kunde.adresse_obj.hausnummerZusatz,
-        "PLZ": kunde.adresse_obj.plz,
-        "Ort": kunde.adresse_obj.ort,
-    }
+    # Filled PDFs are cached until the archived file, the customer or the
+    # field vocabulary change, and clients can revalidate them by ETag
+    matcher_generation = await run_in_threadpool(app.state.field_matcher.current_generation)
+    key = await run_in_threadpool(
+        filled_pdf_key, doc_file, kunde, matcher_generation, llm_fallback=llm_fallback
+    )
+    headers = {"ETag": f'"{key}"', "Cache-Control": "private, no-cache"}
+    if etag_matches(request, headers["ETag"]):
+        return Response(status_code=304, headers=headers)
+
+    # use_cache=false asks for a fresh mapping, which a cached PDF would hide
+    filled_pdf = await run_in_threadpool(app.state.pdf_cache.get, key) if use_cache else None
+    if filled_pdf is not None:
+        return Response(filled_pdf, media_type="application/pdf", headers=headers)
+
+    # Parsing and filling are CPU bound, the field mapping awaits the matcher and LLM itself
+    reader = await run_in_threadpool(PdfReader, doc_file)
+    fields = await run_in_threadpool(lambda: list(reader.get_fields() or {}))
+    field_mapping, complete = await map_fields(fields, llm_fallback, use_cache)
+
+    data = field_values(field_mapping, build_stammdaten(kunde))
+    filled_pdf = await run_in_threadpool(fill_form, reader, data)
+    # Don't keep a PDF that misses fields only because the LLM was unavailable
+    if complete:
+        await run_in_threadpool(app.state.pdf_cache.set, key, filled_pdf)
+    else:
+        headers = {}
+    return Response(filled_pdf, media_type="application/pdf", headers=headers)
 
-    reader = PdfReader(doc_file)
-    # field_mapping = get_field_mapping(stammdaten.keys(), reader.get_fields().keys())
-    field_mapping = {
-        "Name": "Name",
-        "Strasse_Hausnummer": "Strasse",
-        "PLZ_Ort": "PLZ",
-        "Telefonnummer": "Telefonnummer",
-        "IBAN": None,
-        "Vertragsname": None,
-        "Zahlungsart": None,
-        "BIC": None,
-        "Ort": "Ort",
-        "Referenznummer_Vertrag": None,
-        "Adressfeld": None,
-        "Datum_S1": None,
-        "Datum_S2": None,
-    }
-    field_mapping = {k: v for k, v in field_mapping.items() if v is not None}
-    data = {k: stammdaten[v] for k, v in field_mapping.items()}
 
-    # fill pdf
-    writer = PdfWriter()
-    writer.append(reader)
-    writer.set_need_appearances_writer()
+@app.post("/bulk-fill/")
+async def bulk_fill_document(
+    doc_id: int,
+    kunde_ids: Optional[List[int]] = Body(None),
+    llm_fallback: bool = Query(True),
+    use_cache: bool = Query(True),
+    db=Depends(get_async_db),
+):
+    doc = await db.get(models.DokumentLookup, doc_id)
+    if not doc:
+        raise HTTPException(404, {"error": "Document not found"})
+
+    doc_file = os.path.join("/", "server_data", "Archiv", doc.docName)
+    fields = await run_in_threadpool(lambda: list(PdfReader(doc_file).get_fields() or {}))
+    field_mapping, _ = await map_fields(fields, llm_fallback, use_cache)
 
-    for page in writer.pages:
-        writer.update_page_form_field_values(page, data, auto_regenerate=False)
+    # Starlette runs the synchronous generator in its threadpool and sends
+    # every chunk as soon as it is produced
+    def generate():
+        with SessionLocal() as session:
+            yield from bulk_fill(doc_file, field_mapping, session, kunde_ids)
 
-    bio = io.BytesIO()
-    writer.write(bio)
-    filled_pdf = bio.getvalue()
-    return Response(filled_pdf, media_type="application/pdf")
+    filename = os.path.splitext(doc.docOrigName)[0] + ".zip"
+    headers = {"Content-Disposition": f"attachment; filename={filename}"}
+    return StreamingResponse(generate(), media_type="application/zip", headers=headers)
 
 
-@app.get("/chat/")
-async def chat(query: str):
-    chain = ConversationalRetrievalChain.from_llm(
+def get_chain():
+    if app.state.reranker:
+        retriever = RerankingRetriever(
+            retriever=app.state.vectorstore.as_retriever(k=RERANK_CANDIDATES, session_factory=SessionLocal),
+            reranker=app.state.reranker,
+        )
+    else:
+        retriever = app.state.vectorstore.as_retriever(k=CONTEXT_CANDIDATES, session_factory=SessionLocal)
+
+    return ConversationalRetrievalChain.from_llm(
         llm=app.state.llm,
-        retriever=app.state.vectorstore.get_store().as_retriever(search_k=5),
+        # Merges, diversifies and packs the chunks into CONTEXT_MAX_TOKENS
+        retriever=ContextAssembler(
+            retriever=retriever,
+            embeddings=app.state.vectorstore.embedding_model,
+            count_tokens=app.state.llm.count_tokens,
+        ),
         memory=ConversationBufferMemory(
             memory_key="chat_history",
             return_messages=True,
@@ -258,7 +447,54 @@ async def chat(query: str):
         ),
         return_source_documents=True,
     )
-    response = chain(query)
+
+
+@app.get("/chat/")
+async def chat(
+    request: Request,
+    query: str,
+    session_id: Optional[str] = Query(None),
+    stream: bool = Query(False),
+):
+    # Follow-up questions reuse the chain, retriever and history of their session
+    session_id, session = app.state.sessions.get(session_id)
+    headers = {"X-Session-Id": session_id}
+
+    # Only standalone questions are cached, follow-ups depend on the history
+    cacheable = not session.memory.chat_memory.messages
+    cached = await run_in_threadpool(app.state.answer_cache.lookup, query) if cacheable else None
+    if cached:
+        session.memory.save_context({"question": query}, {"answer": cached["answer"]})
+        if stream:
+            return StreamingResponse(
+                stream_cached(cached["answer"], cached["sources"]),
+                media_type="text/event-stream",
+                headers=headers,
+            )
+        return JSONResponse(cached["answer"], headers=headers)
+
+    def remember(response):
+        if cacheable:
+            sources = [serialize_document(doc) for doc in response.get("source_documents", [])]
+            app.state.answer_cache.store(query, response["answer"], sources)
+
+    def run(callbacks):
+        with session.lock:
+            return session.chain.invoke({"question": query}, config={"callbacks": callbacks})
+
+    if stream:
+        # Sources first, then answer tokens as they are generated, then metrics
+        try:
+            events = stream_chain(
+                app.state.scheduler, session.chain, {"question": query}, lock=session.lock, on_done=remember
+            )
+        except queue.Full:
+            raise llm_busy()
+        return StreamingResponse(events, media_type="text/event-stream", headers=headers)
+
+    response = await run_llm(run, INTERACTIVE, request)
+    # Storing embeds the question, which must not block the event loop
+    await run_in_threadpool(remember, response)
 
     # Extract the source documents
     source_documents = response.get("source_documents", [])
@@ -268,5 +504,11 @@ async def chat(query: str):
         print("Documents", doc)
 
     # Return both answer and source documents
-    return response["answer"]
+    return JSONResponse(response["answer"], headers=headers)
+
 
+@app.delete("/chat/")
+def end_chat(session_id: str):
+    if not app.state.sessions.drop(session_id):
+        raise HTTPException(404, {"error": "Session not found"})
+    return Response(status_code=204)
@@ -0,0 +1,97 @@
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+
+from server.diskcache import DiskLRU
+
+FILLED_PDF_CACHE_PATH = os.environ.get(
+    "FILLED_PDF_CACHE_PATH", os.path.join("/", "server_data", "Cache", "filled_pdfs.sqlite")
+)
+FILLED_PDF_CACHE_MEMORY_MB = int(os.environ.get("FILLED_PDF_CACHE_MEMORY_MB", "64"))
+FILLED_PDF_CACHE_DISK_MB = int(os.environ.get("FILLED_PDF_CACHE_DISK_MB", "1024"))
+
+_file_hashes = {}
+_file_hashes_lock = threading.Lock()
+
+
+def archive_hash(path):
+    """sha256 of a file, only recomputed when its size or mtime changed."""
+    stat = os.stat(path)
+    with _file_hashes_lock:
+        cached = _file_hashes.get(path)
+    if cached and cached[:2] == (stat.st_size, stat.st_mtime_ns):
+        return cached[2]
+
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    with _file_hashes_lock:
+        _file_hashes[path] = (stat.st_size, stat.st_mtime_ns, digest.hexdigest())
+    return digest.hexdigest()
+
+
+def filled_pdf_key(doc_file, kunde, matcher_generation, **options):
+    """Cache key and ETag of a form filled with a customer's Stammdaten. It
+    changes whenever the archived file, the Kunde or Adresse row (through
+    their version columns) or the field matcher's vocabulary changes."""
+    parts = {
+        "archive": archive_hash(doc_file),
+        "kunde": [kunde.pkey, kunde.version],
+        "adresse": [kunde.adresse_obj.pkey, kunde.adresse_obj.version],
+        "matcher": matcher_generation,
+        **options,
+    }
+    return hashlib.sha256(json.dumps(parts, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+class FilledPdfCache():
+    """Two-tier cache for filled PDFs: an in-memory LRU of at most
+    `memory_bytes` in front of a DiskLRU. Disk hits are promoted to memory."""
+
+    def __init__(self, memory_bytes=FILLED_PDF_CACHE_MEMORY_MB * 1024 * 1024, disk=None):
+        self.memory_bytes = memory_bytes
+        self.disk = disk or DiskLRU(FILLED_PDF_CACHE_PATH, FILLED_PDF_CACHE_DISK_MB * 1024 * 1024)
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        self.counts = {"memory_hits": 0, "disk_hits": 0, "misses": 0}
+
+    def _remember(self, key, pdf):
+        if len(pdf) > self.memory_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._size -= len(self._entries.pop(key))
+            self._entries[key] = pdf
+            self._size += len(pdf)
+            while self._size > self.memory_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._size -= len(evicted)
+
+    def get(self, key):
+        with self._lock:
+            pdf = self._entries.get(key)
+            if pdf is not None:
+                self._entries.move_to_end(key)
+                self.counts["memory_hits"] += 1
+                return pdf
+
+        pdf = self.disk.get(key)
+        with self._lock:
+            self.counts["disk_hits" if pdf is not None else "misses"] += 1
+        if pdf is not None:
+            self._remember(key, pdf)
+        return pdf
+
+    def set(self, key, pdf):
+        self._remember(key, pdf)
+        self.disk.set(key, pdf)
+
+    def stats(self):
+        with self._lock:
+            memory = {"entries": len(self._entries), "bytes": self._size, "max_bytes": self.memory_bytes}
+            counts = dict(self.counts)
+        return {"memory": memory, "disk": self.disk.stats(), **counts}
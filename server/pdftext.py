@@ -0,0 +1,100 @@
+import heapq
+import logging
+import os
+import time
+from collections import deque, namedtuple
+
+import pypdfium2 as pdfium
+
+PAGES_PER_TASK = int(os.environ.get("PDF_PAGES_PER_TASK", "8"))
+SLOW_PAGE_SECONDS = float(os.environ.get("PDF_SLOW_PAGE_SECONDS", "2"))
+
+PdfPage = namedtuple("PdfPage", ["file", "page", "text", "seconds"])
+
+logger = logging.getLogger(__name__)
+
+
+def _page_count(pdf):
+    doc = pdfium.PdfDocument(pdf)
+    try:
+        return len(doc)
+    finally:
+        doc.close()
+
+
+def _extract_pages(pdf, start, stop):
+    # Runs in the worker processes, so it only returns plain tuples
+    doc = pdfium.PdfDocument(pdf)
+    try:
+        pages = []
+        for i in range(start, stop):
+            page_start = time.perf_counter()
+            page = doc.get_page(i)
+            textpage = page.get_textpage()
+            text = textpage.get_text_bounded()
+            textpage.close()
+            page.close()
+            pages.append((text, time.perf_counter() - page_start))
+        return pages
+    finally:
+        doc.close()
+
+
+def _tasks(files, data):
+    for pdf in files:
+        n_pages = _page_count(data.get(pdf, pdf))
+        for start in range(0, n_pages, PAGES_PER_TASK):
+            yield pdf, start, min(start + PAGES_PER_TASK, n_pages)
+
+
+def _pages(task, extracted):
+    pdf, start, _ = task
+    for offset, (text, seconds) in enumerate(extracted):
+        page = PdfPage(pdf, start + offset, text, seconds)
+        if seconds > SLOW_PAGE_SECONDS:
+            logger.warning(f"Slow page {page.page} in {pdf}: {seconds:.2f}s")
+        else:
+            logger.debug(f"Extracted page {page.page} of {pdf} in {seconds:.3f}s")
+        yield page
+
+
+def iter_pdf_pages(files, executor=None, window=None, data=None):
+    """Yield a PdfPage for every page of every file, in file and page order.
+
+    Pages are extracted in ranges of PAGES_PER_TASK on `executor` if given.
+    At most `window` ranges are in flight at a time, so memory stays flat
+    regardless of how many files are passed in.
+
+    `data` maps files to their contents if the caller already read them.
+    Without an executor the pages are extracted from those bytes instead of
+    reading the files again; the workers of an executor always open the
+    file, which is cheaper than sending them the bytes.
+    """
+    data = data or {}
+    if executor is None:
+        for task in _tasks(files, data):
+            pdf, start, stop = task
+            yield from _pages(task, _extract_pages(data.get(pdf, pdf), start, stop))
+        return
+
+    window = window or 2 * (executor._max_workers or 1)
+    pending = deque()
+    try:
+        for task in _tasks(files, data):
+            pending.append((task, executor.submit(_extract_pages, *task)))
+            if len(pending) >= window:
+                task, future = pending.popleft()
+                yield from _pages(task, future.result())
+        while pending:
+            task, future = pending.popleft()
+            yield from _pages(task, future.result())
+    finally:
+        for _, future in pending:
+            future.cancel()
+
+
+def slowest_pages(pages, n=5):
+    return [
+        {"file": os.path.basename(page.file), "page": page.page, "seconds": page.seconds}
+        for page in heapq.nlargest(n, pages, key=lambda page: page.seconds)
+    ]
@@ -0,0 +1,87 @@
+import os
+import threading
+
+PREFIX_CACHE_MIN_TOKENS = int(os.environ.get("PREFIX_CACHE_MIN_TOKENS", "16"))
+
+_SENTINEL = "\x00PREFIX_END\x00"
+
+
+def template_prefix(prompt):
+    """The rendered text of a prompt template up to its first variable."""
+    rendered = prompt.format_prompt(
+        **{variable: _SENTINEL for variable in prompt.input_variables}
+    ).to_string()
+    return rendered.split(_SENTINEL, 1)[0]
+
+
+class PrefixCache():
+    """Snapshots of llama.cpp state after evaluating the fixed beginning of a
+    prompt template, one per context and template.
+
+    Before a prompt is generated, the snapshot of the template it starts with
+    is restored into the context. llama.cpp then finds the common token prefix
+    with the new prompt and only evaluates the variable rest."""
+
+    def __init__(self, min_tokens=PREFIX_CACHE_MIN_TOKENS):
+        self.min_tokens = min_tokens
+        self.prefixes = []
+        self._tokens = {}
+        self._states = {}
+        self._lock = threading.Lock()
+        self.counts = {"restored": 0, "resident": 0, "snapshots": 0}
+
+    def register(self, prompt):
+        prefix = template_prefix(prompt)
+        with self._lock:
+            if prefix and prefix not in self.prefixes:
+                self.prefixes.append(prefix)
+                # Longest first, so the most specific prefix wins
+                self.prefixes.sort(key=len, reverse=True)
+
+    def _prefix_tokens(self, llama, prefix):
+        key = (id(llama), prefix)
+        if key not in self._tokens:
+            tokens = llama.tokenize(prefix.encode("utf-8"), add_bos=True, special=True)
+            # The last token may merge with the text that follows it
+            self._tokens[key] = tokens[:-1]
+        return self._tokens[key]
+
+    def prepare(self, llama, prompt):
+        """Make sure `llama` (a llama_cpp.Llama) holds the state of the
+        longest registered prefix of `prompt`. Must be called while the
+        context is exclusively checked out."""
+        with self._lock:
+            prefix = next((p for p in self.prefixes if prompt.startswith(p)), None)
+        if prefix is None:
+            return
+
+        tokens = self._prefix_tokens(llama, prefix)
+        if len(tokens) < self.min_tokens:
+            return
+
+        if llama.n_tokens >= len(tokens) and llama.input_ids[: len(tokens)].tolist() == tokens:
+            self.counts["resident"] += 1
+            return
+
+        key = (id(llama), prefix)
+        with self._lock:
+            state = self._states.get(key)
+        if state is not None:
+            llama.load_state(state)
+            self.counts["restored"] += 1
+            return
+
+        llama.reset()
+        llama.eval(tokens)
+        state = llama.save_state()
+        with self._lock:
+            self._states[key] = state
+        self.counts["snapshots"] += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                "prefixes": len(self.prefixes),
+                "snapshot_bytes": sum(state.llama_state_size for state in self._states.values()),
+                **self.counts,
+            }
@@ -1,20 +1,35 @@
 import argparse
 import getpass
+import io
 import logging
+import multiprocessing
 import os
+import time
 import traceback
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime
 
 from pypdf import PdfReader, PdfWriter
-from sqlalchemy import select
+from sqlalchemy import insert, select
 
+from server.diskcache import in_batches
 from server.loggers import fileLogger, splitOutErrLogger
 from server.schlagwortdb import models
 from server.schlagwortdb.database import SessionLocal, engine
+from server.schlagwortdb.migrations import migrate
 from server.vectordb import VectorStore
 
 TIME_FORMAT = "%Y-%m-%d-%H-%M-%S"
 
+DUMP_DIR = os.path.join("/", "server_data", "_Dokumentendump_")
+ARCHIV_DIR = os.path.join("/", "server_data", "Archiv")
+
+# Batch mode: files per embedding/DB batch and chunks per embedding call
+BATCH_SIZE = int(os.environ.get("PROCESS_BATCH_SIZE", "16"))
+EMBED_BATCH = int(os.environ.get("PROCESS_EMBED_BATCH", "256"))
+
 logger = splitOutErrLogger(
     "/server_data/Logs/WSpeicher_Archiv.log",
     "/server_data/Logs/WSpeicher_Error.log",
@@ -24,12 +39,31 @@ logger = splitOutErrLogger(
 loopback_logger = fileLogger("/server_data/Logs/loopback.log", name="loopback", format="%(message)s")
 
 
-def process_document(filename, session, vectorstore):
-    if not filename.endswith(".pdf"):
-        logger.error("Only PDF files are supported. Aborting...")
-        return "ERROR"
+# Result of prepare_document. `data` is the stamped file's content, or None
+# when it was prepared in a worker process
+Prepared = namedtuple("Prepared", ["file_id", "timestamp", "fields", "data", "timings"])
 
-    logger.info(f"Processing document {filename}")
+
+@contextmanager
+def timed(timings, stage):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[stage] = time.perf_counter() - start
+
+
+def format_timings(timings):
+    return ", ".join(f"{stage} {seconds:.3f}s" for stage, seconds in timings.items())
+
+
+def prepare_document(filename, user=None, directory=DUMP_DIR, keep_data=True):
+    """Reads a PDF once, adds the processing metadata as an incremental update
+    and returns its file ID, time stamp, form fields ({name: field type}) and
+    contents. Runs in worker processes in batch mode, so it must not touch the
+    database or the vector store."""
+    path = os.path.join(directory, filename)
+    timings = {}
 
     # Created ID from original name and time stamp
     filename_wo_pdf = filename.rsplit(".")[0]
@@ -38,131 +72,184 @@ def process_document(filename, session, vectorstore):
     logger.debug(f"File ID: {file_id}")
 
     # Get user who started the processing
-    user = getpass.getuser()
+    user = user or getpass.getuser()
     logger.debug(f"User: {user}")
 
-    # Add metadata to the document
-    reader = PdfReader(os.path.join("/", "server_data", "_Dokumentendump_", filename))
-    writer = PdfWriter()
-    writer.append(reader)
-    writer.set_need_appearances_writer()
-    writer.add_metadata(
-        {
-            **reader.metadata,
-            "/FileID": file_id,
-            "/ProcessedAt": timestamp,
-            "/OriginalFileName": filename,
-            "/UserWhoStartedProcessing": user,
-        }
-    )
+    with timed(timings, "read"):
+        with open(path, "rb") as f:
+            data = f.read()
 
-    logger.debug(f"Writing document with added metadata to {filename}")
-    with open(os.path.join("/", "server_data", "_Dokumentendump_", filename), "wb") as f:
-        writer.write(f)
+    with timed(timings, "parse"):
+        reader = PdfReader(io.BytesIO(data))
+        fields = reader.get_fields() or {}
+        fields = {name: field.field_type for name, field in fields.items()}
+    logger.debug(f"Found {len(fields)} fields in {filename}")
+
+    # Add metadata to the document. The incremental update appends the
+    # changed objects to the original bytes instead of rewriting every page
+    with timed(timings, "metadata"):
+        writer = PdfWriter(reader, incremental=True)
+        writer.add_metadata(
+            {
+                "/FileID": file_id,
+                "/ProcessedAt": timestamp,
+                "/OriginalFileName": filename,
+                "/UserWhoStartedProcessing": user,
+            }
+        )
+        bio = io.BytesIO()
+        writer.write(bio)
+        stamped = bio.getvalue()
+
+        logger.debug(f"Writing document with added metadata to {filename}")
+        if stamped.startswith(data):
+            with open(path, "ab") as f:
+                f.write(stamped[len(data) :])
+        else:
+            with open(path, "wb") as f:
+                f.write(stamped)
     logger.info(f"Added metadata for {filename} to {filename}")
 
-    # Add to vector store
-    logger.debug(f"Ingesting {filename} into vector store")
-    vectorstore.injest_files(files=[os.path.join("/", "server_data", "_Dokumentendump_", filename)])
-    logger.info(f"Ingested {filename} into vector store")
+    return Prepared(file_id, timestamp, fields, stamped if keep_data else None, timings)
 
-    # Decide how to process the document based on if it has form fields
-    fields = reader.get_fields()
-    logger.debug(f"Found {len(fields)} fields in {filename}")
 
-    if fields:
-        return process_form(filename, timestamp, session)
-    else:
-        return process_noform(filename, timestamp, session)
+def process_document(filename, session, vectorstore, directory=DUMP_DIR):
+    if not filename.endswith(".pdf"):
+        logger.error("Only PDF files are supported. Aborting...")
+        return "ERROR"
+
+    logger.info(f"Processing document {filename}")
+    prepared = prepare_document(filename, directory=directory)
+    timings = prepared.timings
 
+    status = "ERROR"
+    try:
+        # Add to vector store, from the bytes that are already in memory
+        logger.debug(f"Ingesting {filename} into vector store")
+        with timed(timings, "ingest"):
+            vectorstore.upsert_document(
+                os.path.join(directory, filename), document_id=prepared.file_id, data=prepared.data
+            )
+        logger.info(f"Ingested {filename} into vector store")
+
+        # Decide how to process the document based on if it has form fields
+        with timed(timings, "record"):
+            if prepared.fields:
+                status = process_form(filename, prepared.file_id, prepared.fields, session, directory=directory)
+            else:
+                status = process_noform(filename, prepared.timestamp, session)
+    finally:
+        if status != "SUCCESS":
+            discard_chunks(vectorstore, prepared.file_id)
+    logger.info(f"Timings for {filename}: {format_timings(timings)}")
+    return status
+
+
+def discard_chunks(vectorstore, file_id):
+    """Deletes the chunks of a document that wasn't archived. Its file stays
+    in the dump folder and is ingested under a new file ID on the next run,
+    so the chunks would otherwise pile up."""
+    try:
+        vectorstore.delete_document(file_id)
+    except Exception as e:
+        logger.error(f"Could not delete the chunks of {file_id}: {e}")
 
-def process_form(filename, timestamp, session):
-    logger.info(f"Processing document with form fields {filename}")
 
-    reader = PdfReader(os.path.join("/", "server_data", "_Dokumentendump_", filename))
-    fields = reader.get_fields()
+def record_form(filename, file_id, fields, session):
+    """Adds the document and its fields to the session without committing.
+    Field names that are a synonym of a Schlagwort are linked to it instead
+    of becoming a new Schlagwort.
 
-    file_id = reader.metadata["/FileID"]
+    All Schlagworte and Felder of the form are looked up with one IN query
+    each and missing ones are inserted in bulk, so the number of statements
+    doesn't grow with the number of fields."""
     doc = models.DokumentLookup(docName=file_id, docOrigName=filename)
     session.add(doc)
     session.flush()
     logger.debug(f"Added document '{file_id}' to DokumentLookup table (not commited)")
 
-    # Go through all fields and process them individually
-    error = False
-    for name, field in fields.items():
-        logger.debug(f"Processing field '{name}' of type {field.field_type}")
-
-        # Check if Schlagwort exists in database
-        schlagwort = session.execute(
-            select(models.Schlagwort).where(models.Schlagwort.schlagwort == name)
-        ).scalar()
-
-        # If not, check if synonym exists in database
-        if not schlagwort:
-            # Add schlagwort to DB
-            schlagwort = models.Schlagwort(schlagwort=name)
-            session.add(schlagwort)
-            session.flush()
-            logger.debug(f"Added Schlgwrt '{name}' to Schlagworte table (not commited)")
-
-            # logger.debug(
-            #     f"Schlagwort '{name}' not found in database. Checking synonyms"
-            # )
-            # synonym = session.execute(
-            #     select(models.Synonym).where(models.Synonym.synonym == name)
-            # ).scalar()
-            # if not synonym:
-            #     logger.error(f"No synonym for Schlagwort '{name}' found in database.")
-            #     loopback_logger.info(
-            #         "%s\t%s\t%s\t%s", timestamp, filename, 1, "Schlagwort not found"
-            #     )
-            #     error = True
-            #     continue
-
-            # schlagwort = synonym.schlagwort_obj.schlagwort
-
-        # Add field to database
-        logger.info(f"Found Schlagwort '{schlagwort}' in database")
-
-        # TODO: should normally (according to Liss) be added unconditionally
-        # Not sure how that would work out though...
-        feld = session.execute(
-            select(models.Feld)
-            .where(models.Feld.feldname == name)
-        ).scalar()
-        if not feld:
-            feld = models.Feld(
-                schlagwort=schlagwort.pkey, feldname=name, feldtyp=field.field_type
-            )
-            session.add(feld)
-            logger.debug(f"Added field '{name}' to Felder table (not commited)")
-
-        # Add field to schlagwort_dokument
-        session.add(
-            models.SchlagwortDokument(schlagwort=schlagwort.pkey, dokument=doc.pkey)
+    names = list(fields)
+
+    # Schlagworte aren't unique, the oldest one wins
+    schlagworte = {}
+    for batch in in_batches(names):
+        for pkey, schlagwort in session.execute(
+            select(models.Schlagwort.pkey, models.Schlagwort.schlagwort)
+            .where(models.Schlagwort.schlagwort.in_(batch))
+            .order_by(models.Schlagwort.pkey)
+        ):
+            schlagworte.setdefault(schlagwort, pkey)
+    logger.debug(f"Found {len(schlagworte)} of {len(names)} Schlagworte in database")
+
+    unknown = [name for name in names if name not in schlagworte]
+    for batch in in_batches(unknown):
+        for pkey, synonym in session.execute(
+            select(models.Synonym.schlagwort, models.Synonym.synonym)
+            .where(models.Synonym.synonym.in_(batch))
+            .order_by(models.Synonym.pkey)
+        ):
+            schlagworte.setdefault(synonym, pkey)
+    logger.debug(f"Found {len(unknown) - len(set(unknown) - set(schlagworte))} field names as synonyms")
+
+    missing = [name for name in names if name not in schlagworte]
+    if missing:
+        for pkey, schlagwort in session.execute(
+            insert(models.Schlagwort).returning(models.Schlagwort.pkey, models.Schlagwort.schlagwort),
+            [{"schlagwort": name} for name in missing],
+        ):
+            schlagworte[schlagwort] = pkey
+        logger.debug(f"Added {len(missing)} Schlagworte to Schlagworte table (not commited)")
+
+    # TODO: should normally (according to Liss) be added unconditionally
+    # Not sure how that would work out though...
+    felder = set()
+    for batch in in_batches(names):
+        felder.update(
+            session.execute(select(models.Feld.feldname).where(models.Feld.feldname.in_(batch))).scalars()
         )
-        logger.debug(f"Added field '{name}' to SchlagwortDokument table (not commited)")
+    new_felder = [
+        {"schlagwort": schlagworte[name], "feldname": name, "feldtyp": field_type}
+        for name, field_type in fields.items()
+        if name not in felder
+    ]
+    if new_felder:
+        session.execute(insert(models.Feld), new_felder)
+        logger.debug(f"Added {len(new_felder)} fields to Felder table (not commited)")
+
+    if names:
+        session.execute(
+            insert(models.SchlagwortDokument),
+            [{"schlagwort": schlagworte[name], "dokument": doc.pkey} for name in names],
+        )
+        logger.debug(f"Added {len(names)} fields to SchlagwortDokument table (not commited)")
+
+    logger.info(f"Recorded {len(names)} fields of {filename} ({len(missing)} new Schlagworte)")
+
+
+def archive_document(filename, file_id, directory=DUMP_DIR):
+    os.rename(os.path.join(directory, filename), os.path.join(ARCHIV_DIR, file_id))
+    logger.debug(f"Moved {filename} to Archiv/{file_id}")
+
 
-    if not error:
+def process_form(filename, file_id, fields, session, directory=DUMP_DIR):
+    logger.info(f"Processing document with form fields {filename}")
+
+    try:
+        record_form(filename, file_id, fields, session)
         logger.debug(f"No errors occurred. Committing session and moving to Archiv...")
         session.commit()
         logger.debug(f"Commited session")
+    except Exception:
+        logger.error(f"Errors occurred. Rolling back session...")
+        session.rollback()
+        logger.debug(f"Rolled back session")
+        raise
 
-        # Move document to Archiv
-        os.rename(
-            os.path.join("/", "server_data", "_Dokumentendump_", filename), 
-            os.path.join("/", "server_data", "Archiv", file_id)
-        )
-        logger.debug(f"Moved {filename} to Archiv/{file_id}")
+    # Move document to Archiv
+    archive_document(filename, file_id, directory)
 
-        logger.info(f"Succesfully processed document {filename}")
-        return "SUCCESS"
-
-    logger.error(f"Errors occurred. Rolling back session...")
-    session.rollback()
-    logger.debug(f"Rolled back session")
-    return "ERROR"
+    logger.info(f"Succesfully processed document {filename}")
+    return "SUCCESS"
 
 
 def process_noform(*args):
@@ -170,17 +257,171 @@ def process_noform(*args):
     return "ERROR"
 
 
+def _ingest_batch(prepared, vectorstore, directory):
+    """Ingests the prepared files together and returns the ones that failed.
+    If the batch fails as a whole, every file is retried on its own."""
+    files = [os.path.join(directory, filename) for filename in prepared]
+    file_ids = [p.file_id for p in prepared.values()]
+    try:
+        vectorstore.injest_files(files, document_ids=file_ids, embed_batch=EMBED_BATCH)
+        return {}
+    except Exception as e:
+        logger.warning(f"Ingesting batch of {len(files)} files failed ({e}), retrying one by one")
+
+    failed = {}
+    for filename, p in prepared.items():
+        try:
+            vectorstore.upsert_document(os.path.join(directory, filename), document_id=p.file_id)
+        except Exception as e:
+            logger.error(f"Ingesting {filename} failed: {e}. Traceback:\n{traceback.format_exc()}")
+            failed[filename] = e
+    return failed
+
+
+def _record_batch(forms, session, directory):
+    """Records all forms in one transaction, archives the recorded ones and
+    returns {filename: error} for the ones that failed. If the transaction
+    fails, every form is recorded in its own."""
+
+    def commit(batch):
+        for filename, p in batch.items():
+            record_form(filename, p.file_id, p.fields, session)
+        session.commit()
+
+    failed = {}
+    committed = list(forms)
+    try:
+        commit(forms)
+    except Exception as e:
+        session.rollback()
+        logger.warning(f"Recording batch of {len(forms)} forms failed ({e}), retrying one by one")
+
+        committed = []
+        for filename, prepared in forms.items():
+            try:
+                commit({filename: prepared})
+                committed.append(filename)
+            except Exception as e:
+                session.rollback()
+                logger.error(f"Recording {filename} failed: {e}. Traceback:\n{traceback.format_exc()}")
+                failed[filename] = f"database: {e}"
+
+    # Outside the retries, recording a committed form again would duplicate its rows
+    for filename in committed:
+        try:
+            archive_document(filename, forms[filename].file_id, directory)
+        except Exception as e:
+            logger.error(f"Recorded {filename} but could not move it to Archiv: {e}")
+            failed[filename] = f"recorded, but not archived: {e}"
+    return failed
+
+
+def process_batch(filenames, session, vectorstore, workers=None, batch_size=BATCH_SIZE, directory=DUMP_DIR):
+    """Processes many documents in one process. Worker processes add the
+    metadata and read the form fields, the embeddings and database writes are
+    done in batches of `batch_size` files. A file that fails is reported and
+    skipped. Returns {filename: status}."""
+    start = time.time()
+    statuses = {}
+
+    def report(filename, status, detail=""):
+        statuses[filename] = status
+        print(f"{status}\t{filename}\t{detail}".rstrip(), flush=True)
+
+    pdfs = []
+    for filename in filenames:
+        if filename.endswith(".pdf"):
+            pdfs.append(filename)
+        else:
+            logger.error(f"Only PDF files are supported. Skipping {filename}")
+            report(filename, "ERROR", "not a PDF")
+
+    user = getpass.getuser()
+    # spawn, because forking a process that holds torch and CUDA state is unsafe
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as executor:
+        futures = {
+            filename: executor.submit(prepare_document, filename, user, directory, keep_data=False)
+            for filename in pdfs
+        }
+        for i in range(0, len(pdfs), batch_size):
+            prepared = {}
+            for filename in pdfs[i : i + batch_size]:
+                logger.info(f"Processing document {filename}")
+                try:
+                    prepared[filename] = futures[filename].result()
+                    logger.info(f"Timings for {filename}: {format_timings(prepared[filename].timings)}")
+                except Exception as e:
+                    logger.error(f"Preparing {filename} failed: {e}")
+                    report(filename, "ERROR", f"prepare: {e}")
+
+            batch_timings = {}
+            with timed(batch_timings, "ingest"):
+                failed = _ingest_batch(prepared, vectorstore, directory)
+            for filename, e in failed.items():
+                discard_chunks(vectorstore, prepared.pop(filename).file_id)
+                report(filename, "ERROR", f"ingest: {e}")
+
+            forms = {filename: p for filename, p in prepared.items() if p.fields}
+            for filename, p in prepared.items():
+                if filename not in forms:
+                    status = process_noform(filename)
+                    if status != "SUCCESS":
+                        discard_chunks(vectorstore, p.file_id)
+                    report(filename, status, "no form fields")
+
+            with timed(batch_timings, "record"):
+                failed = _record_batch(forms, session, directory)
+            logger.info(f"Timings for batch of {len(prepared)} files: {format_timings(batch_timings)}")
+            for filename, p in forms.items():
+                if filename in failed:
+                    discard_chunks(vectorstore, p.file_id)
+                    report(filename, "ERROR", failed[filename])
+                else:
+                    logger.info(f"Succesfully processed document {filename}")
+                    report(filename, "SUCCESS", f"{p.file_id} ({len(p.fields)} fields)")
+
+    elapsed = time.time() - start
+    succeeded = sum(status == "SUCCESS" for status in statuses.values())
+    print(
+        f"Processed {len(statuses)} files in {elapsed:.1f}s "
+        f"({len(statuses) / elapsed if elapsed else 0:.2f} files/s): "
+        f"{succeeded} succeeded, {len(statuses) - succeeded} failed"
+    )
+    return statuses
+
+
 if __name__ == "__main__":
-    parser = argparse.ArgumentParser(description="Process a document")
-    parser.add_argument("document", type=str, help="The document to process")
+    parser = argparse.ArgumentParser(description="Process documents")
+    parser.add_argument(
+        "documents",
+        type=str,
+        nargs="*",
+        help="The documents to process. Without any, all PDFs in --dir are processed",
+    )
+    parser.add_argument("--dir", default=DUMP_DIR, help="Directory the documents are in")
+    parser.add_argument("--workers", type=int, default=None, help="Processes that prepare the PDFs")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE, help="Files per DB and embedding batch")
 
     try:
         args = parser.parse_args()
-        models.Base.metadata.create_all(bind=engine)
+        migrate(engine)
         session = SessionLocal()
         vectorstore = VectorStore()
-        status = process_document(args.document, session, vectorstore)
-        print(status)
+        if len(args.documents) == 1:
+            status = process_document(args.documents[0], session, vectorstore, directory=args.dir)
+            print(status)
+        else:
+            documents = args.documents or sorted(
+                name for name in os.listdir(args.dir) if name.endswith(".pdf")
+            )
+            process_batch(
+                documents,
+                session,
+                vectorstore,
+                workers=args.workers,
+                batch_size=args.batch_size,
+                directory=args.dir,
+            )
     except Exception as e:
         logger.critical(f"An error occurred: {e}. Traceback:\n{traceback.format_exc()}")
         print("ERROR_FATAL")
@@ -0,0 +1,166 @@
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Any
+
+from langchain_core.callbacks import CallbackManagerForRetrieverRun
+from langchain_core.retrievers import BaseRetriever
+
+from server.embeddings import content_hash
+
+logger = logging.getLogger(__name__)
+
+# "1" adds the cross-encoder between retrieval and the context assembler of /chat/
+RERANK = os.environ.get("RERANK", "0") == "1"
+# Small multilingual MiniLM trained on mMARCO, handles German queries and passages
+RERANK_MODEL = os.environ.get("RERANK_MODEL", "cross-encoder/mmarco-mMiniLMv2-L12-H384-v1")
+# Chunks retrieved for reranking and chunks kept afterwards
+RERANK_CANDIDATES = int(os.environ.get("RERANK_CANDIDATES", "20"))
+RERANK_TOP_N = int(os.environ.get("RERANK_TOP_N", "6"))
+# Milliseconds of scoring per query, candidates that don't fit keep their retrieval order
+RERANK_BUDGET_MS = float(os.environ.get("RERANK_BUDGET_MS", "250"))
+RERANK_CACHE_SIZE = int(os.environ.get("RERANK_CACHE_SIZE", "10000"))
+RERANK_THREADS = int(os.environ.get("RERANK_THREADS", "0"))
+
+
+class CrossEncoderReranker():
+    """Scores (query, chunk) pairs with a cross-encoder on the CPU.
+
+    All pairs of a query are scored in one batch. To stay within the latency
+    budget, only as many candidates as the measured cost per pair allows are
+    scored, best retrieved first. Scores are kept in an LRU cache, so
+    follow-up and repeated questions mostly cost nothing."""
+
+    def __init__(
+        self,
+        model_name=RERANK_MODEL,
+        budget_ms=RERANK_BUDGET_MS,
+        cache_size=RERANK_CACHE_SIZE,
+        threads=RERANK_THREADS,
+    ):
+        self.model_name = model_name
+        self.budget = budget_ms / 1000
+        self.cache_size = cache_size
+        self.threads = threads
+        self._model = None
+        self._seconds_per_pair = None
+        self._scores = OrderedDict()
+        self._lock = threading.Lock()
+        self._model_lock = threading.Lock()
+        self.counts = {
+            "queries": 0,
+            "candidates": 0,
+            "kept": 0,
+            "dropped": 0,
+            "scored": 0,
+            "cached": 0,
+            "over_budget": 0,
+            "seconds": 0.0,
+        }
+
+    def _load(self):
+        import torch
+        from sentence_transformers import CrossEncoder
+
+        if self.threads:
+            torch.set_num_threads(self.threads)
+        return CrossEncoder(self.model_name, device="cpu", max_length=512)
+
+    def _predict(self, pairs):
+        with self._model_lock:
+            if self._model is None:
+                self._model = self._load()
+            start = time.perf_counter()
+            scores = self._model.predict(pairs, batch_size=len(pairs), show_progress_bar=False)
+            seconds = time.perf_counter() - start
+        # Moving average, so a single slow batch doesn't starve the next queries
+        per_pair = seconds / len(pairs)
+        with self._lock:
+            if self._seconds_per_pair is None:
+                self._seconds_per_pair = per_pair
+            else:
+                self._seconds_per_pair = 0.8 * self._seconds_per_pair + 0.2 * per_pair
+        return [float(score) for score in scores]
+
+    def score(self, query, texts):
+        """Scores of `texts`, in retrieval order, for `query`. Texts that
+        didn't fit into the budget get None."""
+        keys = [(query, content_hash(text)) for text in texts]
+        with self._lock:
+            scores = [self._scores.get(key) for key in keys]
+            for key, score in zip(keys, scores):
+                if score is not None:
+                    self._scores.move_to_end(key)
+            affordable = (
+                len(texts) if self._seconds_per_pair is None else int(self.budget / self._seconds_per_pair)
+            )
+
+        missing = [i for i, score in enumerate(scores) if score is None]
+        todo = missing[: max(affordable, 1)]
+        if todo:
+            for i, score in zip(todo, self._predict([(query, texts[i]) for i in todo])):
+                scores[i] = score
+            with self._lock:
+                for i in todo:
+                    self._scores[keys[i]] = scores[i]
+                while len(self._scores) > self.cache_size:
+                    self._scores.popitem(last=False)
+
+        with self._lock:
+            self.counts["scored"] += len(todo)
+            self.counts["cached"] += len(texts) - len(missing)
+            self.counts["over_budget"] += len(missing) > len(todo)
+        return scores
+
+    def record(self, candidates, kept, seconds):
+        with self._lock:
+            self.counts["queries"] += 1
+            self.counts["candidates"] += candidates
+            self.counts["kept"] += kept
+            self.counts["dropped"] += candidates - kept
+            self.counts["seconds"] += seconds
+
+    def stats(self):
+        with self._lock:
+            queries = self.counts["queries"]
+            return {
+                "model": self.model_name,
+                "loaded": self._model is not None,
+                "cache_entries": len(self._scores),
+                "ms_per_pair": self._seconds_per_pair * 1000 if self._seconds_per_pair else None,
+                "mean_latency_ms": self.counts["seconds"] / queries * 1000 if queries else None,
+                **self.counts,
+            }
+
+
+class RerankingRetriever(BaseRetriever):
+    """Reorders the chunks of another retriever by cross-encoder score and
+    keeps the best `top_n`. Chunks that weren't scored within the latency
+    budget follow the scored ones in their retrieval order."""
+
+    retriever: BaseRetriever
+    reranker: Any
+    top_n: int = RERANK_TOP_N
+
+    def _get_relevant_documents(self, query: str, *, run_manager: CallbackManagerForRetrieverRun):
+        docs = self.retriever.invoke(query, config={"callbacks": run_manager.get_child()})
+        if not docs:
+            return []
+
+        start = time.perf_counter()
+        scores = self.reranker.score(query, [doc.page_content for doc in docs])
+        ranked = sorted(
+            range(len(docs)),
+            key=lambda i: (scores[i] is None, -scores[i] if scores[i] is not None else i),
+        )
+        kept = []
+        for i in ranked[: self.top_n]:
+            docs[i].metadata = {**docs[i].metadata, "rerank_score": scores[i]}
+            kept.append(docs[i])
+        seconds = time.perf_counter() - start
+
+        self.reranker.record(len(docs), len(kept), seconds)
+        logger.debug(f"Reranked {len(docs)} chunks in {seconds * 1000:.0f} ms, dropped {len(docs) - len(kept)}")
+        return kept
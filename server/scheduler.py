@@ -0,0 +1,173 @@
+import asyncio
+import itertools
+import os
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+
+from langchain_core.callbacks import BaseCallbackHandler
+
+# Lower numbers run first
+INTERACTIVE = 0
+BATCH = 10
+
+LLM_QUEUE_SIZE = int(os.environ.get("LLM_QUEUE_SIZE", "64"))
+LLM_TIMEOUT = float(os.environ.get("LLM_TIMEOUT", "300"))
+
+
+class InferenceCancelled(Exception):
+    pass
+
+
+class InferenceTimeout(Exception):
+    pass
+
+
+class CancelHandler(BaseCallbackHandler):
+    # Raising from a callback aborts the LLM call between two tokens
+    raise_error = True
+
+    def __init__(self, job):
+        self.job = job
+
+    def _check(self, *args, **kwargs):
+        self.job.check()
+
+    on_chain_start = _check
+    on_llm_start = _check
+    on_llm_new_token = _check
+    on_retriever_start = _check
+
+
+class InferenceJob():
+    def __init__(self, fn, priority, timeout, seq):
+        self.fn = fn
+        self.priority = priority
+        self.seq = seq
+        self.future = Future()
+        self.cancelled = threading.Event()
+        self.enqueued_at = time.monotonic()
+        self.deadline = self.enqueued_at + timeout
+        self.started_at = None
+
+    def __lt__(self, other):
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+    def cancel(self):
+        self.cancelled.set()
+
+    def check(self):
+        if self.cancelled.is_set():
+            raise InferenceCancelled("Request was cancelled")
+        if time.monotonic() > self.deadline:
+            raise InferenceTimeout("Request took too long")
+
+
+class InferenceScheduler():
+    """Runs blocking LLM calls on dedicated worker threads, highest priority
+    first. Every call gets a deadline and can be cancelled while it waits in
+    the queue or between two generated tokens.
+
+    Submitted functions are called with a list of callbacks, which they must
+    pass on to the chain or LLM they run."""
+
+    def __init__(self, workers=1, max_queue=LLM_QUEUE_SIZE, timeout=LLM_TIMEOUT):
+        self.timeout = timeout
+        self._queue = queue.PriorityQueue(maxsize=max_queue)
+        self._seq = itertools.count()
+        self._lock = threading.Lock()
+        self._waits = deque(maxlen=100)
+        self.running = 0
+        self.counts = {"completed": 0, "failed": 0, "cancelled": 0, "timed_out": 0}
+        self._threads = [
+            threading.Thread(target=self._work, name=f"llm-{i}", daemon=True)
+            for i in range(workers)
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def submit(self, fn, priority=INTERACTIVE, timeout=None):
+        # Raises queue.Full when the queue is at capacity
+        job = InferenceJob(fn, priority, timeout or self.timeout, next(self._seq))
+        self._queue.put_nowait(job)
+        return job
+
+    async def run(self, fn, priority=INTERACTIVE, timeout=None, request=None):
+        """Submit `fn` and wait for its result without blocking the event loop.
+        If `request` is given, the job is cancelled when its client disconnects."""
+        job = self.submit(fn, priority, timeout)
+        result = asyncio.wrap_future(job.future)
+        try:
+            while True:
+                done, _ = await asyncio.wait({result}, timeout=0.5)
+                if done:
+                    return result.result()
+                if request is not None and await request.is_disconnected():
+                    job.cancel()
+        finally:
+            job.cancel()
+
+    def _work(self):
+        while True:
+            job = self._queue.get()
+            if isinstance(job, _Stop):
+                break
+
+            # False if the waiting coroutine was cancelled while queued
+            if not job.future.set_running_or_notify_cancel():
+                with self._lock:
+                    self.counts["cancelled"] += 1
+                self._queue.task_done()
+                continue
+
+            with self._lock:
+                self._waits.append(time.monotonic() - job.enqueued_at)
+                self.running += 1
+            job.started_at = time.monotonic()
+            try:
+                job.check()
+                job.future.set_result(job.fn([CancelHandler(job)]))
+                outcome = "completed"
+            except InferenceCancelled as e:
+                job.future.set_exception(e)
+                outcome = "cancelled"
+            except InferenceTimeout as e:
+                job.future.set_exception(e)
+                outcome = "timed_out"
+            except Exception as e:
+                job.future.set_exception(e)
+                outcome = "failed"
+            finally:
+                with self._lock:
+                    self.running -= 1
+                self._queue.task_done()
+            with self._lock:
+                self.counts[outcome] += 1
+
+    def shutdown(self):
+        for _ in self._threads:
+            self._queue.put(_Stop())
+
+    def stats(self):
+        with self._lock:
+            waits = list(self._waits)
+            return {
+                "workers": len(self._threads),
+                "queue_depth": self._queue.qsize(),
+                "max_queue": self._queue.maxsize,
+                "running": self.running,
+                **self.counts,
+                "avg_wait": sum(waits) / len(waits) if waits else None,
+                "max_wait": max(waits) if waits else None,
+            }
+
+
+class _Stop():
+    # Sorts after every real job
+    priority = float("inf")
+    seq = 0
+
+    def __lt__(self, other):
+        return False
@@ -0,0 +1,24 @@
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+
+from server.schlagwortdb.database import (
+    SQLITE_BUSY_TIMEOUT,
+    SQLITE_DB,
+    SQLITE_MAX_OVERFLOW,
+    SQLITE_POOL_SIZE,
+    set_sqlite_pragmas,
+)
+
+# The same database through aiosqlite, for the async FastAPI endpoints. Kept
+# apart from database.py so the command line tools don't need aiosqlite
+SQLALCHEMY_ASYNC_DATABASE_URL = f"sqlite+aiosqlite:///{SQLITE_DB}"
+
+async_engine = create_async_engine(
+    SQLALCHEMY_ASYNC_DATABASE_URL,
+    connect_args={"timeout": SQLITE_BUSY_TIMEOUT},
+    pool_size=SQLITE_POOL_SIZE,
+    max_overflow=SQLITE_MAX_OVERFLOW,
+)
+event.listen(async_engine.sync_engine, "connect", set_sqlite_pragmas)
+
+AsyncSessionLocal = async_sessionmaker(async_engine, autoflush=False, expire_on_commit=False)
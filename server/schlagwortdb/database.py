@@ -1,6 +1,6 @@
 import os
 
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
 from sqlalchemy.orm import declarative_base, sessionmaker
 
 default_db = os.path.join(
@@ -10,7 +10,36 @@ default_db = os.path.join(
 SQLITE_DB = os.environ.get("SQLITE_DB", default_db)
 SQLALCHEMY_DATABASE_URL = f"sqlite:///{SQLITE_DB}"
 
-engine = create_engine(SQLALCHEMY_DATABASE_URL)
+# Seconds a connection waits for another writer before "database is locked"
+SQLITE_BUSY_TIMEOUT = float(os.environ.get("SQLITE_BUSY_TIMEOUT", "30"))
+SQLITE_CACHE_MB = int(os.environ.get("SQLITE_CACHE_MB", "64"))
+SQLITE_MMAP_MB = int(os.environ.get("SQLITE_MMAP_MB", "256"))
+SQLITE_POOL_SIZE = int(os.environ.get("SQLITE_POOL_SIZE", "8"))
+SQLITE_MAX_OVERFLOW = int(os.environ.get("SQLITE_MAX_OVERFLOW", "16"))
+
+
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    # WAL lets readers run while one writer commits. With WAL, synchronous=NORMAL
+    # only syncs at checkpoints and can't corrupt the database on a crash
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute(f"PRAGMA busy_timeout={int(SQLITE_BUSY_TIMEOUT * 1000)}")
+    cursor.execute(f"PRAGMA cache_size=-{SQLITE_CACHE_MB * 1024}")
+    cursor.execute(f"PRAGMA mmap_size={SQLITE_MMAP_MB * 1024 * 1024}")
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    cursor.close()
+
+
+engine = create_engine(
+    SQLALCHEMY_DATABASE_URL,
+    # Pooled connections are handed between the threads of FastAPI's threadpool
+    connect_args={"check_same_thread": False, "timeout": SQLITE_BUSY_TIMEOUT},
+    pool_size=SQLITE_POOL_SIZE,
+    max_overflow=SQLITE_MAX_OVERFLOW,
+    pool_pre_ping=True,
+)
+event.listen(engine, "connect", set_sqlite_pragmas)
 
 # Create database if it doesn't exist
 with engine.connect() as conn:
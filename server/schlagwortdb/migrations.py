@@ -0,0 +1,38 @@
+from sqlalchemy import inspect, text
+
+from server.schlagwortdb import models
+
+# Columns added to existing tables: (table, column, SQLite definition)
+COLUMNS = [
+    ("Kunde", "version", "INTEGER NOT NULL DEFAULT 0"),
+    ("Adresse", "version", "INTEGER NOT NULL DEFAULT 0"),
+]
+
+# Bump the version of a customer or address on every update, also when it is
+# edited outside of SQLAlchemy, so caches keyed on it are invalidated
+TRIGGERS = [
+    f"""
+    CREATE TRIGGER IF NOT EXISTS "{table}_version" AFTER UPDATE ON "{table}"
+    WHEN NEW.version = OLD.version
+    BEGIN
+        UPDATE "{table}" SET version = OLD.version + 1 WHERE pkey = NEW.pkey;
+    END
+    """
+    for table in ["Kunde", "Adresse"]
+]
+
+
+def migrate(engine):
+    """Brings an existing database up to date with the models. create_all
+    only creates missing tables, so columns and indexes added to existing
+    tables are created here."""
+    models.Base.metadata.create_all(bind=engine)
+    with engine.begin() as conn:
+        for table, column, definition in COLUMNS:
+            if column not in {c["name"] for c in inspect(conn).get_columns(table)}:
+                conn.execute(text(f'ALTER TABLE "{table}" ADD COLUMN {column} {definition}'))
+        for table in models.Base.metadata.sorted_tables:
+            for index in table.indexes:
+                index.create(conn, checkfirst=True)
+        for trigger in TRIGGERS:
+            conn.execute(text(trigger))
@@ -1,6 +1,6 @@
 from typing import List
 
-from sqlalchemy import ForeignKey
+from sqlalchemy import ForeignKey, Index
 from sqlalchemy.orm import Mapped, mapped_column, relationship
 from sqlalchemy.sql.sqltypes import Text
 
@@ -9,7 +9,10 @@ from server.schlagwortdb.database import Base
 
 class Schlagwort(Base):
     __tablename__ = "Schlagworte"
-    __table_args__ = {"sqlite_autoincrement": True}
+    __table_args__ = (
+        Index("ix_Schlagworte_schlagwort", "schlagwort"),
+        {"sqlite_autoincrement": True},
+    )
 
     pkey: Mapped[int] = mapped_column(primary_key=True)
     schlagwort: Mapped[str] = mapped_column(type_=Text(), server_default="empty")
@@ -28,7 +31,10 @@ class Schlagwort(Base):
 
 class Synonym(Base):
     __tablename__ = "Synonyme"
-    __table_args__ = {"sqlite_autoincrement": True}
+    __table_args__ = (
+        Index("ix_Synonyme_synonym", "synonym"),
+        {"sqlite_autoincrement": True},
+    )
 
     pkey: Mapped[int] = mapped_column(primary_key=True)
     schlagwort: Mapped[int] = mapped_column(
@@ -73,7 +79,10 @@ class DokumentLookup(Base):
 
 class SchlagwortDokument(Base):
     __tablename__ = "Schlagwort_Dokument"
-    __table_args__ = {"sqlite_autoincrement": True}
+    __table_args__ = (
+        Index("ix_Schlagwort_Dokument_schlagwort_dokument", "schlagwort", "dokument"),
+        {"sqlite_autoincrement": True},
+    )
 
     pkey: Mapped[int] = mapped_column(primary_key=True)
     schlagwort: Mapped[int] = mapped_column(ForeignKey("Schlagworte.pkey"))
@@ -93,6 +102,8 @@ class Adresse(Base):
     hausnummerZusatz: Mapped[str] = mapped_column(type_=Text(), server_default="empty")
     plz: Mapped[int] = mapped_column(server_default="10000")
     ort: Mapped[str] = mapped_column(type_=Text(), server_default="empty")
+    # Incremented by a trigger on every update, see migrations.py
+    version: Mapped[int] = mapped_column(server_default="0")
 
 
 class Kunde(Base):
@@ -111,5 +122,7 @@ class Kunde(Base):
     email: Mapped[str] = mapped_column(type_=Text(), nullable=True)
     familienstand: Mapped[int] = mapped_column(nullable=True)
     adresse: Mapped[int] = mapped_column(ForeignKey("Adresse.pkey"))
+    # Incremented by a trigger on every update, see migrations.py
+    version: Mapped[int] = mapped_column(server_default="0")
 
     adresse_obj = relationship("Adresse")
@@ -0,0 +1,89 @@
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+MAX_SESSIONS = int(os.environ.get("CHAT_SESSION_MAX", "256"))
+SESSION_TTL = float(os.environ.get("CHAT_SESSION_TTL", "1800"))
+MAX_HISTORY_MESSAGES = int(os.environ.get("CHAT_SESSION_MAX_MESSAGES", "20"))
+
+
+class ChatSession():
+    def __init__(self, chain):
+        self.chain = chain
+        self.retriever = chain.retriever
+        self.memory = chain.memory
+        self.lock = threading.Lock()
+        self.last_used = time.monotonic()
+
+    def trim_history(self, max_messages):
+        messages = self.memory.chat_memory.messages
+        if len(messages) > max_messages:
+            # Drop the oldest question/answer pairs first
+            del messages[: len(messages) - max_messages]
+
+
+class SessionStore():
+    """Keeps one conversation chain per session id, evicting the least
+    recently used sessions and sessions idle for longer than the TTL."""
+
+    def __init__(
+        self,
+        factory,
+        max_sessions=MAX_SESSIONS,
+        ttl=SESSION_TTL,
+        max_history_messages=MAX_HISTORY_MESSAGES,
+    ):
+        self.factory = factory
+        self.max_sessions = max_sessions
+        self.ttl = ttl
+        self.max_history_messages = max_history_messages
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+        self.created = 0
+        self.evicted = 0
+
+    def get(self, session_id=None):
+        with self._lock:
+            now = time.monotonic()
+            self._evict_expired(now)
+
+            session = self._sessions.get(session_id) if session_id else None
+            if session is None:
+                session_id = session_id or uuid.uuid4().hex
+                session = ChatSession(self.factory())
+                self._sessions[session_id] = session
+                self.created += 1
+                while len(self._sessions) > self.max_sessions:
+                    self._sessions.popitem(last=False)
+                    self.evicted += 1
+            else:
+                self._sessions.move_to_end(session_id)
+
+            session.last_used = now
+            session.trim_history(self.max_history_messages)
+            return session_id, session
+
+    def drop(self, session_id):
+        with self._lock:
+            return self._sessions.pop(session_id, None) is not None
+
+    def _evict_expired(self, now):
+        # Sessions are ordered by last use, so expired ones are at the front
+        while self._sessions:
+            session_id, session = next(iter(self._sessions.items()))
+            if now - session.last_used < self.ttl:
+                break
+            del self._sessions[session_id]
+            self.evicted += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                "sessions": len(self._sessions),
+                "max_sessions": self.max_sessions,
+                "ttl": self.ttl,
+                "created": self.created,
+                "evicted": self.evicted,
+            }
@@ -0,0 +1,123 @@
+import asyncio
+import json
+import time
+from contextlib import nullcontext
+
+from fastapi.concurrency import run_in_threadpool
+from langchain_core.callbacks import BaseCallbackHandler
+
+from server.scheduler import INTERACTIVE
+
+
+def sse(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+def serialize_document(doc):
+    return {"page_content": doc.page_content, "metadata": doc.metadata}
+
+
+class TokenQueueHandler(BaseCallbackHandler):
+    def __init__(self, put):
+        self.put = put
+        self.retrieved = False
+        self._retrievers = set()
+
+    def on_retriever_start(self, serialized, query, *, run_id, **kwargs):
+        self._retrievers.add(run_id)
+
+    def on_retriever_end(self, documents, *, run_id, parent_run_id=None, **kwargs):
+        # Retrievers wrapped by another one (like the vector search of the
+        # hybrid retriever) report too, only the outermost one's documents
+        # are the sources
+        if parent_run_id in self._retrievers:
+            return
+        self.retrieved = True
+        self.put(("sources", documents))
+
+    def on_llm_new_token(self, token, **kwargs):
+        # Tokens generated before retrieval belong to the condense-question
+        # step and are not part of the answer
+        if self.retrieved:
+            self.put(("token", token))
+
+
+def stream_cached(answer, sources):
+    yield sse("sources", sources)
+    yield sse("token", answer)
+    yield sse(
+        "done",
+        {
+            "answer": answer,
+            "cached": True,
+            "time_to_first_token": 0.0,
+            "tokens": 0,
+            "tokens_per_second": None,
+            "total_time": 0.0,
+        },
+    )
+
+
+def stream_chain(scheduler, chain, inputs, lock=None, on_done=None, priority=INTERACTIVE):
+    """Run a retrieval chain on the inference scheduler and return an async
+    generator of its sources, answer tokens and timing metrics as Server-Sent
+    Events. `on_done` is called in the threadpool with the chain's response
+    once it finished successfully. Raises queue.Full if the scheduler can't
+    take the request."""
+    loop = asyncio.get_running_loop()
+    events = asyncio.Queue()
+
+    def put(event):
+        loop.call_soon_threadsafe(events.put_nowait, event)
+
+    handler = TokenQueueHandler(put)
+
+    def run(callbacks):
+        with lock or nullcontext():
+            return chain.invoke(inputs, config={"callbacks": [*callbacks, handler]})
+
+    start = time.time()
+    job = scheduler.submit(run, priority=priority)
+    job.future.add_done_callback(lambda future: put(("end", None)))
+    return _stream_events(job, events, start, on_done)
+
+
+async def _stream_events(job, events, start, on_done):
+    first_token_at = None
+    n_tokens = 0
+    try:
+        while True:
+            kind, payload = await events.get()
+            if kind == "sources":
+                yield sse("sources", [serialize_document(doc) for doc in payload])
+            elif kind == "token":
+                if first_token_at is None:
+                    first_token_at = time.time()
+                n_tokens += 1
+                yield sse("token", payload)
+            else:
+                break
+    finally:
+        # Stops the generation if the client went away
+        job.cancel()
+    end = time.time()
+
+    if job.future.exception():
+        yield sse("error", {"error": str(job.future.exception())})
+        return
+    response = job.future.result()
+    if on_done:
+        await run_in_threadpool(on_done, response)
+
+    generation_time = end - first_token_at if first_token_at else 0.0
+    yield sse(
+        "done",
+        {
+            "answer": response["answer"],
+            "cached": False,
+            "time_to_first_token": first_token_at - start if first_token_at else None,
+            "tokens": n_tokens,
+            "tokens_per_second": n_tokens / generation_time if generation_time else None,
+            "total_time": end - start,
+        },
+    )
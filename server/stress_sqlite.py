@@ -0,0 +1,117 @@
+import argparse
+import asyncio
+import os
+import random
+import tempfile
+import threading
+import time
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))] if values else None
+
+
+def writer(stop, latencies, errors, n):
+    # Same write pattern as process_document: a document with its fields in one transaction
+    from server.process_document import record_form
+    from server.schlagwortdb.database import SessionLocal
+
+    session = SessionLocal()
+    i = 0
+    while not stop.is_set():
+        fields = {f"Feld_{n}_{random.randrange(2000)}": "/Tx" for _ in range(50)}
+        start = time.perf_counter()
+        try:
+            record_form(f"stress_{n}_{i}.pdf", f"stress_{n}_{i}", fields, session)
+            session.commit()
+            latencies.append(time.perf_counter() - start)
+        except Exception as e:
+            session.rollback()
+            errors.append(repr(e))
+        i += 1
+    session.close()
+
+
+async def reader(stop, latencies, errors, kunde_ids):
+    # Same read pattern as /get-document/
+    from sqlalchemy.orm import selectinload
+
+    from server.schlagwortdb import models
+    from server.schlagwortdb.async_database import AsyncSessionLocal
+
+    while not stop.is_set():
+        start = time.perf_counter()
+        try:
+            async with AsyncSessionLocal() as db:
+                await db.get(models.DokumentLookup, random.randrange(1, 1000))
+                await db.get(
+                    models.Kunde, random.choice(kunde_ids), options=[selectinload(models.Kunde.adresse_obj)]
+                )
+            latencies.append(time.perf_counter() - start)
+        except Exception as e:
+            errors.append(repr(e))
+
+
+def seed():
+    from server.schlagwortdb import models
+    from server.schlagwortdb.database import SessionLocal
+
+    with SessionLocal() as session:
+        for i in range(100):
+            adresse = models.Adresse(strasse=f"Strasse {i}", ort="Berlin")
+            session.add(adresse)
+            session.flush()
+            session.add(models.Kunde(vorname=f"Vorname {i}", name=f"Name {i}", adresse=adresse.pkey))
+        session.commit()
+        return [kunde.pkey for kunde in session.query(models.Kunde).all()]
+
+
+async def main(args):
+    from server.schlagwortdb.database import engine
+    from server.schlagwortdb.migrations import migrate
+
+    migrate(engine)
+    kunde_ids = seed()
+
+    stop = threading.Event()
+    write_latencies, read_latencies, errors = [], [], []
+    threads = [
+        threading.Thread(target=writer, args=(stop, write_latencies, errors, n)) for n in range(args.writers)
+    ]
+    for thread in threads:
+        thread.start()
+    readers = [
+        asyncio.create_task(reader(stop, read_latencies, errors, kunde_ids)) for _ in range(args.readers)
+    ]
+
+    await asyncio.sleep(args.seconds)
+    stop.set()
+    await asyncio.gather(*readers)
+    for thread in threads:
+        thread.join()
+
+    for name, latencies in [("writes", write_latencies), ("reads", read_latencies)]:
+        p50, p99 = percentile(latencies, 0.5), percentile(latencies, 0.99)
+        print(
+            f"{name}: {len(latencies) / args.seconds:.1f}/s, "
+            f"p50 {p50 * 1000 if p50 else 0:.1f} ms, p99 {p99 * 1000 if p99 else 0:.1f} ms"
+        )
+    locked = sum("database is locked" in error for error in errors)
+    print(f"errors: {len(errors)} ({locked} 'database is locked')")
+    for error in sorted(set(errors))[:5]:
+        print(f"  {error}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Concurrent reads and writes against the Schlagwort database")
+    parser.add_argument("--writers", type=int, default=4, help="Threads recording forms")
+    parser.add_argument("--readers", type=int, default=16, help="Async sessions reading documents")
+    parser.add_argument("--seconds", type=float, default=10)
+    parser.add_argument("--db", help="Database file, a temporary one by default")
+    args = parser.parse_args()
+
+    # Must be set before the database module is imported
+    with tempfile.TemporaryDirectory() as tmp:
+        os.environ["SQLITE_DB"] = args.db or os.path.join(tmp, "stress.sqlite")
+        asyncio.run(main(args))
@@ -0,0 +1,108 @@
+import hashlib
+import os
+import tempfile
+
+from fastapi.concurrency import run_in_threadpool
+from starlette.responses import JSONResponse
+
+UPLOAD_DIR = os.environ.get("UPLOAD_DIR", os.path.join("/", "server_data", "uploads"))
+UPLOAD_MAX_MB = int(os.environ.get("UPLOAD_MAX_MB", "100"))
+UPLOAD_CHUNK_KB = int(os.environ.get("UPLOAD_CHUNK_KB", "1024"))
+
+
+class UploadTooLarge(Exception):
+    def __init__(self, max_bytes):
+        super().__init__(f"Upload exceeds the limit of {max_bytes / 1024 / 1024:.0f} MB")
+        self.max_bytes = max_bytes
+
+
+class ReceivedUpload():
+    """An upload copied to a temporary file in the upload directory. It only
+    appears under its real name with `commit`, by an atomic rename, so readers
+    never see a partial file. Uncommitted uploads are deleted on exit."""
+
+    def __init__(self, filename, directory):
+        os.makedirs(directory, exist_ok=True)
+        # basename, the client chooses the name
+        self.filename = os.path.basename(filename)
+        self.directory = directory
+        fd, self.tmp_path = tempfile.mkstemp(dir=directory, prefix=".upload-", suffix=".part")
+        self._file = os.fdopen(fd, "wb")
+        self.sha256 = None
+        self.size = 0
+        self.path = None
+
+    def commit(self):
+        # One directory per content hash, so a later upload with the same name
+        # can't replace the file a queued job is about to read. The basename,
+        # which becomes the document id, stays the same
+        directory = os.path.join(self.directory, self.sha256)
+        os.makedirs(directory, exist_ok=True)
+        self.path = os.path.join(directory, self.filename)
+        os.replace(self.tmp_path, self.path)
+        return self.path
+
+    def discard(self):
+        """Removes a committed upload again, with its hash directory if that
+        is now empty."""
+        if self.path is None:
+            return
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        try:
+            os.rmdir(os.path.dirname(self.path))
+        except OSError:
+            pass  # another upload with the same content is still there
+        self.path = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        if not self._file.closed:
+            self._file.close()
+        if self.path is None and os.path.exists(self.tmp_path):
+            os.remove(self.tmp_path)
+
+
+async def receive_upload(file, directory=UPLOAD_DIR, max_bytes=UPLOAD_MAX_MB * 1024 * 1024):
+    """Copies an UploadFile to disk chunk by chunk, hashing it on the way.
+    Raises UploadTooLarge as soon as more than `max_bytes` arrived."""
+    upload = ReceivedUpload(file.filename, directory)
+    try:
+        digest = hashlib.sha256()
+        while chunk := await file.read(UPLOAD_CHUNK_KB * 1024):
+            upload.size += len(chunk)
+            if upload.size > max_bytes:
+                raise UploadTooLarge(max_bytes)
+            digest.update(chunk)
+            await run_in_threadpool(upload._file.write, chunk)
+        await run_in_threadpool(upload._file.flush)
+        await run_in_threadpool(os.fsync, upload._file.fileno())
+        upload._file.close()
+        upload.sha256 = digest.hexdigest()
+    except BaseException:
+        await upload.__aexit__()
+        raise
+    return upload
+
+
+class UploadLimitMiddleware():
+    """Rejects requests to `paths` whose Content-Length is above `max_bytes`
+    with 413, before the body is read and spooled to disk. Uploads without
+    Content-Length are checked while they are copied."""
+
+    def __init__(self, app, paths, max_bytes=UPLOAD_MAX_MB * 1024 * 1024):
+        self.app = app
+        self.paths = tuple(paths)
+        self.max_bytes = max_bytes
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and scope["path"] in self.paths:
+            length = dict(scope["headers"]).get(b"content-length")
+            if length and length.isdigit() and int(length) > self.max_bytes:
+                response = JSONResponse(
+                    {"detail": {"error": str(UploadTooLarge(self.max_bytes))}}, status_code=413
+                )
+                return await response(scope, receive, send)
+        await self.app(scope, receive, send)
@@ -1,10 +1,27 @@
+import hashlib
+import itertools
+import multiprocessing
 import os
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor
 
-import torch
-import pypdfium2 as pdfium
-from langchain_community.embeddings import HuggingFaceEmbeddings
 from langchain_community.vectorstores.pgvector import PGVector
-from langchain_text_splitters import RecursiveCharacterTextSplitter
+from sqlalchemy.orm import Session
+
+from server.chunking import PageChunker
+from server.embeddings import CachedEmbeddings, cache_namespace, content_hash, make_embeddings
+from server.hybrid import HybridRetriever, KeywordIndex, SynonymExpander
+from server.localindex import LocalVectorIndex
+from server.pdftext import iter_pdf_pages, slowest_pages
+
+
+def file_hash(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
 
 
 class VectorStore():
@@ -18,47 +35,276 @@ class VectorStore():
         password=os.environ.get("PGVECTOR_PASSWORD", "password"),
     )
 
+    # "pgvector" or "local" for the in-process index stored under LOCAL_PATH
+    BACKEND = os.environ.get("VECTORDB_BACKEND", "pgvector")
+    LOCAL_PATH = os.environ.get(
+        "VECTORDB_LOCAL_PATH", os.path.join("/", "server_data", "VectorIndex")
+    )
+
+    # Combine vector search with BM25 keyword search over the same chunks
+    HYBRID = os.environ.get("HYBRID_RETRIEVAL", "1") == "1"
+    TOP_K = int(os.environ.get("RETRIEVAL_TOP_K", "4"))
+    # Seconds the generation read from Postgres is reused. Writes of this
+    # process update it at once, those of other processes within this time
+    GENERATION_TTL = float(os.environ.get("VECTORDB_GENERATION_TTL", "5"))
+
     model_name = "danielheinz/e5-base-sts-en-de"#"BAAI/bge-small-en-v1.5"
-    model_kwargs = {'device': 'cuda'}
-    encode_kwargs = {'normalize_embeddings': False}
+
+    pdf_workers = int(os.environ.get("PDF_EXTRACT_WORKERS", str(os.cpu_count() or 1)))
 
     def __init__(self):
-        # chek if on mac or windows
-        if os.name == 'posix':
-            self.model_kwargs = {'device': 'cpu' if not torch.cuda.is_available() else "gpu"}
-
-        self.embedding_model = HuggingFaceEmbeddings(
-            model_name=self.model_name,
-            model_kwargs=self.model_kwargs,
-            encode_kwargs=self.encode_kwargs
+        # Vectors are cached on disk, so identical chunks are embedded only once
+        self.embedding_model = CachedEmbeddings(
+            make_embeddings(self.model_name), namespace=cache_namespace(self.model_name)
         )
 
-        self.store = PGVector(
-            collection_name=self.COLLECTION_NAME,
-            connection_string=self.CONNECTION_STRING,
-            embedding_function=self.embedding_model,
-            pre_delete_collection=True,
-        )
+        if self.BACKEND == "local":
+            self.store = LocalVectorIndex(
+                os.path.join(self.LOCAL_PATH, self.COLLECTION_NAME),
+                embedding_function=self.embedding_model,
+            )
+        elif self.BACKEND == "pgvector":
+            self.store = PGVector(
+                collection_name=self.COLLECTION_NAME,
+                connection_string=self.CONNECTION_STRING,
+                embedding_function=self.embedding_model,
+                pre_delete_collection=False,
+            )
+        else:
+            raise ValueError(f"Unknown vector database backend {self.BACKEND}")
+        self.verify()
+
+        self.keywords = KeywordIndex() if self.HYBRID else None
+        self.chunker = PageChunker()
+        self._generation = None
+        self._pdf_executor = None
 
     def get_store(self):
         return self.store
 
-    def injest_files(self, files):
-        pdf_text = self.get_pdf_text(files)
-        text_chunks = self.get_text_chunks(pdf_text)
-        self.store.add_texts(text_chunks)
+    def as_retriever(self, k=TOP_K, session_factory=None):
+        if not self.HYBRID:
+            return self.store.as_retriever(search_kwargs={"k": k})
+        return HybridRetriever(
+            vector_retriever=self.store.as_retriever(search_kwargs={"k": 2 * k}),
+            keyword_index=self.keywords,
+            expander=SynonymExpander(session_factory) if session_factory else None,
+            k=k,
+            fetch_k=2 * k,
+        )
+
+    def verify(self):
+        # The collection is persistent, startup only checks that it is reachable
+        if self.BACKEND == "local":
+            count = self.store.count()
+            print(f"Local index {self.store.path} contains {count} chunks")
+            return count
+
+        EmbeddingStore = self.store.EmbeddingStore
+        with Session(self.store._bind) as session:
+            collection = self.store.get_collection(session)
+            if not collection:
+                raise RuntimeError(f"Collection {self.COLLECTION_NAME} not found")
+            count = session.query(EmbeddingStore).filter(
+                EmbeddingStore.collection_id == collection.uuid
+            ).count()
+        print(f"Collection {self.COLLECTION_NAME} contains {count} chunks")
+        return count
+
+    def injest_files(
+        self, files, progress=None, document_ids=None, force=False, embed_batch=0, data=None, digests=None
+    ):
+        # progress(stage, done, total) is called as the stages advance.
+        # Chunks of consecutive files are embedded and inserted together
+        # until at least `embed_batch` chunks are pending. `data` holds the
+        # contents of the files and `digests` their sha256 if the caller
+        # already read or hashed them
+        progress = progress or (lambda stage, done, total: None)
+        document_ids = document_ids or [os.path.basename(file) for file in files]
+        data = dict(zip(files, data)) if data else {}
+        digests = dict(zip(files, digests)) if digests else {}
+
+        # Documents whose file did not change since they were ingested are skipped
+        todo = {}
+        for file, document_id in zip(files, document_ids):
+            if file in digests:
+                digest = digests[file]
+            elif file in data:
+                digest = hashlib.sha256(data[file]).hexdigest()
+            else:
+                digest = file_hash(file)
+            if (
+                force
+                or self.document_file_hash(document_id) != digest
+                # Documents ingested before hybrid retrieval was enabled
+                or (self.keywords and not self.keywords.has_document(document_id))
+            ):
+                todo[file] = (document_id, digest)
+
+        # Files are chunked, embedded and inserted a few at a time while the
+        # pool keeps extracting the following pages, so memory stays flat
+        n_chunks = 0
+        timings = []
+        pending = []
+
+        def flush(done):
+            texts = [text for _, chunks in pending for text, _ in chunks.values()]
+            embeddings = self.embedding_model.embed_documents(texts)
+            progress("embed", done, len(todo))
+
+            start = 0
+            for document_id, chunks in pending:
+                self.delete_document(document_id)
+                if chunks:
+                    end = start + len(chunks)
+                    metadatas = [metadata for _, metadata in chunks.values()]
+                    self.store.add_embeddings(
+                        texts=texts[start:end],
+                        embeddings=embeddings[start:end],
+                        metadatas=metadatas,
+                        ids=list(chunks),
+                    )
+                    if self.keywords:
+                        self.keywords.add(list(chunks), texts[start:end], metadatas)
+                    start = end
+            self._bump_generation()
+            progress("insert", done, len(todo))
+            pending.clear()
+
+        pages = self.iter_pdf_pages(list(todo), data=data)
+        for i, (file, file_pages) in enumerate(itertools.groupby(pages, key=lambda page: page.file)):
+            file_pages = list(file_pages)
+            timings.extend(page._replace(text="") for page in file_pages)
+            progress("extract", i + 1, len(todo))
+
+            document_id, digest = todo[file]
+            chunks = {}
+            for chunk in self.chunker.split(file_pages):
+                chunks[f"{document_id}:{content_hash(chunk.text)}"] = (
+                    chunk.text,
+                    {
+                        "document_id": document_id,
+                        "file_hash": digest,
+                        "source": os.path.basename(file),
+                        "page": chunk.page,
+                        "offset": chunk.offset,
+                    },
+                )
+            progress("chunk", i + 1, len(todo))
+
+            pending.append((document_id, chunks))
+            n_chunks += len(chunks)
+            if sum(len(chunks) for _, chunks in pending) >= embed_batch:
+                flush(i + 1)
+        if pending:
+            flush(len(todo))
+
+        return {
+            "files": len(files),
+            "unchanged": len(files) - len(todo),
+            "chunks": n_chunks,
+            "slowest_pages": slowest_pages(timings),
+        }
+
+    def generation(self):
+        # Stamp of the current set of documents, shared by all processes
+        if self.BACKEND == "local":
+            return self.store.generation()
+
+        # (stamp, time read), a tuple so threads replace it in one assignment
+        cached = self._generation
+        if cached and time.monotonic() - cached[1] < self.GENERATION_TTL:
+            return cached[0]
+        with Session(self.store._bind) as session:
+            collection = self.store.get_collection(session)
+            generation = (collection.cmetadata or {}).get("generation")
+        self._generation = (generation, time.monotonic())
+        return generation
+
+    def _bump_generation(self):
+        if self.BACKEND == "local":
+            return  # every write to the local index changes its generation
+
+        with Session(self.store._bind) as session:
+            collection = self.store.get_collection(session)
+            generation = uuid.uuid4().hex
+            collection.cmetadata = {**(collection.cmetadata or {}), "generation": generation}
+            session.commit()
+        self._generation = (generation, time.monotonic())
+
+    def upsert_document(self, file, document_id=None, progress=None, data=None):
+        return self.injest_files(
+            [file],
+            progress=progress,
+            document_ids=[document_id] if document_id else None,
+            data=[data] if data is not None else None,
+        )
+
+    def replace_document(self, file, document_id=None, progress=None):
+        return self.injest_files(
+            [file], progress=progress, document_ids=[document_id] if document_id else None, force=True
+        )
+
+    def _document_query(self, session, document_id):
+        # Chunk ids are "<document id>:<chunk hash>"
+        EmbeddingStore = self.store.EmbeddingStore
+        collection = self.store.get_collection(session)
+        return session.query(EmbeddingStore).filter(
+            EmbeddingStore.collection_id == collection.uuid,
+            EmbeddingStore.custom_id.startswith(f"{document_id}:", autoescape=True),
+        )
+
+    def document_file_hash(self, document_id):
+        if self.BACKEND == "local":
+            ids = self.store.ids_with_prefix(f"{document_id}:")
+            return self.store.get_metadata(ids[0]).get("file_hash") if ids else None
+
+        with Session(self.store._bind) as session:
+            chunk = self._document_query(session, document_id).first()
+            return chunk.cmetadata.get("file_hash") if chunk else None
+
+    def find_by_file_hash(self, digest):
+        """Id of a document ingested from a file with this sha256, or None."""
+        if self.BACKEND == "local":
+            metadata = self.store.find_metadata("file_hash", digest)
+            return metadata["document_id"] if metadata else None
+
+        EmbeddingStore = self.store.EmbeddingStore
+        with Session(self.store._bind) as session:
+            collection = self.store.get_collection(session)
+            chunk = session.query(EmbeddingStore).filter(
+                EmbeddingStore.collection_id == collection.uuid,
+                EmbeddingStore.cmetadata["file_hash"].as_string() == digest,
+            ).first()
+            return chunk.cmetadata.get("document_id") if chunk else None
+
+    def delete_document(self, document_id):
+        if self.keywords:
+            self.keywords.delete_document(document_id)
+
+        if self.BACKEND == "local":
+            ids = self.store.ids_with_prefix(f"{document_id}:")
+            if ids:
+                self.store.delete(ids)
+            return len(ids)
+
+        with Session(self.store._bind) as session:
+            deleted = self._document_query(session, document_id).delete(synchronize_session=False)
+            session.commit()
+        if deleted:
+            self._bump_generation()
+        return deleted
+
+    def get_pdf_executor(self):
+        if self._pdf_executor is None and self.pdf_workers > 1:
+            # spawn, because forking a process that holds torch and CUDA state is unsafe
+            self._pdf_executor = ProcessPoolExecutor(
+                max_workers=self.pdf_workers, mp_context=multiprocessing.get_context("spawn")
+            )
+        return self._pdf_executor
 
-    def get_text_chunks(self, text):
-        text_splitter = RecursiveCharacterTextSplitter(chunk_size=400, chunk_overlap=50)
-        chunks = text_splitter.split_text(text)
-        return chunks
+    def iter_pdf_pages(self, pdf_docs, data=None):
+        return iter_pdf_pages(pdf_docs, executor=self.get_pdf_executor(), data=data)
 
     def get_pdf_text(self, pdf_docs):
-        text = ""
-        for pdf in pdf_docs:
-            pdf_reader = pdfium.PdfDocument(pdf)
-            for i in range(len(pdf_reader)):
-                page = pdf_reader.get_page(i)
-                textpage = page.get_textpage()
-                text += textpage.get_text_bounded() + "\n"
-        return text
+        return "".join(page.text + "\n" for page in self.iter_pdf_pages(pdf_docs))
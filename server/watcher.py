@@ -0,0 +1,271 @@
+import argparse
+import logging
+import os
+import queue
+import signal
+import sqlite3
+import threading
+import time
+import traceback
+from collections import deque
+from datetime import datetime
+
+from server.loggers import splitOutErrLogger
+from server.process_document import DUMP_DIR, TIME_FORMAT, loopback_logger, process_document
+from server.schlagwortdb.database import SessionLocal, engine
+from server.schlagwortdb.migrations import migrate
+from server.vectordb import VectorStore
+
+WATCH_INTERVAL = float(os.environ.get("WATCH_INTERVAL", "2"))
+# A file is picked up once its size and mtime didn't change for this long
+WATCH_SETTLE_SECONDS = float(os.environ.get("WATCH_SETTLE_SECONDS", "5"))
+WATCH_WORKERS = int(os.environ.get("WATCH_WORKERS", "2"))
+WATCH_REPORT_SECONDS = float(os.environ.get("WATCH_REPORT_SECONDS", "60"))
+WATCH_JOURNAL = os.environ.get(
+    "WATCH_JOURNAL", os.path.join("/", "server_data", "Conf", "watcher_journal.sqlite")
+)
+
+logger = splitOutErrLogger(
+    "/server_data/Logs/WSpeicher_Archiv.log",
+    "/server_data/Logs/WSpeicher_Error.log",
+    name=__name__,
+    level=logging.INFO,
+)
+
+
+class Journal():
+    """Persistent record of every file the watcher has seen. A file is known
+    by its name, size and mtime, so a file that is replaced is processed
+    again while an unchanged one never is."""
+
+    def __init__(self, path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS files ("
+            "name TEXT PRIMARY KEY, size INTEGER, mtime REAL, status TEXT NOT NULL, "
+            "detected_at REAL, started_at REAL, finished_at REAL, result TEXT)"
+        )
+
+    def is_known(self, name, size, mtime):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT size, mtime FROM files WHERE name = ?", (name,)
+            ).fetchone()
+        return row is not None and row[0] == size and row[1] == mtime
+
+    def queued(self, name, size, mtime, detected_at):
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO files (name, size, mtime, status, detected_at) VALUES (?, ?, ?, 'queued', ?)",
+                (name, size, mtime, detected_at),
+            )
+
+    def started(self, name):
+        with self._lock:
+            self._conn.execute(
+                "UPDATE files SET status = 'processing', started_at = ? WHERE name = ?", (time.time(), name)
+            )
+
+    def finished(self, name, status, result, size=None, mtime=None):
+        # Processing stamps the file, so its new size and mtime are recorded
+        # to not pick it up again if it stays in the folder
+        with self._lock:
+            self._conn.execute(
+                "UPDATE files SET status = ?, result = ?, finished_at = ?, "
+                "size = COALESCE(?, size), mtime = COALESCE(?, mtime) WHERE name = ?",
+                (status, result, time.time(), size, mtime, name),
+            )
+
+    def unfinished(self):
+        with self._lock:
+            return self._conn.execute(
+                "SELECT name, detected_at FROM files WHERE status IN ('queued', 'processing') ORDER BY detected_at"
+            ).fetchall()
+
+
+class FolderWatcher():
+    """Polls a folder for new PDFs and runs process_document on them with a
+    pool of worker threads. Files are only picked up once they stopped
+    changing, so files that are still being written are not processed."""
+
+    def __init__(
+        self,
+        directory=DUMP_DIR,
+        journal=None,
+        vectorstore=None,
+        workers=WATCH_WORKERS,
+        interval=WATCH_INTERVAL,
+        settle=WATCH_SETTLE_SECONDS,
+    ):
+        self.directory = directory
+        self.journal = journal or Journal(WATCH_JOURNAL)
+        self.vectorstore = vectorstore or VectorStore()
+        self.interval = interval
+        self.settle = settle
+        self._queue = queue.Queue()
+        self._pending = {}  # name -> (size, mtime, first seen with that size and mtime)
+        # Names queued or processing. Processing stamps the file, so its size
+        # and mtime change before the journal knows them. Until then scan must
+        # leave the file alone, or it would queue it a second time
+        self._active = set()
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        self._latencies = deque(maxlen=100)
+        self.running = 0
+        self.counts = {"succeeded": 0, "failed": 0}
+        self._threads = [
+            threading.Thread(target=self._work, name=f"watcher-{i}", daemon=True) for i in range(workers)
+        ]
+
+    def _recover(self):
+        # Files that were queued or processing when the watcher stopped
+        for name, detected_at in self.journal.unfinished():
+            if os.path.exists(os.path.join(self.directory, name)):
+                logger.info(f"Resuming {name} from journal")
+                with self._lock:
+                    self._active.add(name)
+                self._queue.put((name, detected_at))
+            else:
+                # Successfully processed files are moved to the Archiv
+                self.journal.finished(name, "unknown", "File left the folder before the watcher restarted")
+
+    def scan(self):
+        now = time.time()
+        seen = set()
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                if not entry.is_file() or not entry.name.endswith(".pdf"):
+                    continue
+                seen.add(entry.name)
+                with self._lock:
+                    if entry.name in self._active:
+                        continue
+                stat = entry.stat()
+                if self.journal.is_known(entry.name, stat.st_size, stat.st_mtime):
+                    continue
+
+                size, mtime, since = self._pending.get(entry.name, (None, None, now))
+                if (size, mtime) != (stat.st_size, stat.st_mtime):
+                    self._pending[entry.name] = (stat.st_size, stat.st_mtime, now)
+                elif now - since >= self.settle:
+                    del self._pending[entry.name]
+                    with self._lock:
+                        self._active.add(entry.name)
+                    self.journal.queued(entry.name, stat.st_size, stat.st_mtime, now)
+                    self._queue.put((entry.name, now))
+                    logger.info(f"Queued {entry.name}")
+
+        # Forget files that disappeared while settling
+        for name in set(self._pending) - seen:
+            del self._pending[name]
+
+    def _work(self):
+        session = SessionLocal()
+        try:
+            while True:
+                item = self._queue.get()
+                if item is None:
+                    break
+                self._process(session, *item)
+        finally:
+            session.close()
+
+    def _process(self, session, name, detected_at):
+        with self._lock:
+            self.running += 1
+        self.journal.started(name)
+        timestamp = datetime.now().strftime(TIME_FORMAT)
+        try:
+            status = process_document(name, session, self.vectorstore, directory=self.directory)
+            message = "Processed" if status == "SUCCESS" else "Processing failed"
+        except Exception as e:
+            session.rollback()
+            logger.error(f"Processing {name} failed: {e}. Traceback:\n{traceback.format_exc()}")
+            status, message = "ERROR", str(e)
+
+        latency = time.time() - detected_at
+        path = os.path.join(self.directory, name)
+        try:
+            stat = os.stat(path) if os.path.exists(path) else None
+            self.journal.finished(
+                name,
+                "done" if status == "SUCCESS" else "error",
+                status,
+                size=stat.st_size if stat else None,
+                mtime=stat.st_mtime if stat else None,
+            )
+        finally:
+            # Only now the journal knows the stamped size and mtime
+            with self._lock:
+                self._active.discard(name)
+        loopback_logger.info("%s\t%s\t%s\t%s", timestamp, name, 0 if status == "SUCCESS" else 1, message)
+        with self._lock:
+            self.running -= 1
+            self._latencies.append(latency)
+            self.counts["succeeded" if status == "SUCCESS" else "failed"] += 1
+        logger.info(f"{status} {name} after {latency:.1f}s")
+
+    def stats(self):
+        with self._lock:
+            latencies = list(self._latencies)
+            return {
+                "queue_length": self._queue.qsize(),
+                "settling": len(self._pending),
+                "active": len(self._active),
+                "running": self.running,
+                **self.counts,
+                "avg_latency": sum(latencies) / len(latencies) if latencies else None,
+                "max_latency": max(latencies) if latencies else None,
+            }
+
+    def run(self):
+        self._recover()
+        for thread in self._threads:
+            thread.start()
+
+        logger.info(f"Watching {self.directory} with {len(self._threads)} workers")
+        last_report = time.monotonic()
+        while not self._stop.is_set():
+            try:
+                self.scan()
+            except OSError as e:
+                logger.error(f"Scanning {self.directory} failed: {e}")
+            if time.monotonic() - last_report >= WATCH_REPORT_SECONDS:
+                logger.info(f"Watcher stats: {self.stats()}")
+                last_report = time.monotonic()
+            self._stop.wait(self.interval)
+
+        # Files still queued stay in the journal and are resumed on restart
+        while True:
+            try:
+                self._queue.get_nowait()
+            except queue.Empty:
+                break
+        for _ in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+        logger.info(f"Watcher stopped: {self.stats()}")
+
+    def stop(self, *args):
+        self._stop.set()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Process documents dropped into a folder")
+    parser.add_argument("--dir", default=DUMP_DIR, help="Folder to watch")
+    parser.add_argument("--workers", type=int, default=WATCH_WORKERS)
+    parser.add_argument("--interval", type=float, default=WATCH_INTERVAL, help="Seconds between scans")
+    parser.add_argument(
+        "--settle", type=float, default=WATCH_SETTLE_SECONDS, help="Seconds a file must not change"
+    )
+    args = parser.parse_args()
+
+    migrate(engine)
+    watcher = FolderWatcher(args.dir, workers=args.workers, interval=args.interval, settle=args.settle)
+    signal.signal(signal.SIGTERM, watcher.stop)
+    signal.signal(signal.SIGINT, watcher.stop)
+    watcher.run()